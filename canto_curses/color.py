@@ -13,17 +13,28 @@ from .config import config
 # color code, convert a symbolic color name (e.g. "unread") into a code to put
 # in a theme string
 
+# The codes only change with the color / style config, so they're cached, as
+# are templates built from them (see template()), until the next change.
+
 class CantoColorManager:
     def __init__(self):
         self.color_conf = config.get_opt("color")
         self.style_conf = config.get_opt("style")
+        self.reset_cache()
         on_hook("curses_opt_change", self.on_opt_change, self)
 
+    def reset_cache(self):
+        self.codes = {}
+        self.end_codes = {}
+        self.templates = {}
+
     def on_opt_change(self, config):
         if "color" in config:
             self.color_conf = config["color"]
         if "style" in config:
             self.style_conf = config["style"]
+        if "color" in config or "style" in config:
+            self.reset_cache()
 
     def _invert(self, codes):
         inverted = ""
@@ -50,6 +61,9 @@ class CantoColorManager:
         return inverted
 
     def __call__(self, name):
+        if name in self.codes:
+            return self.codes[name]
+
         color = ""
 
         if self.color_conf[name] > 8:
@@ -57,9 +71,28 @@ class CantoColorManager:
         elif self.color_conf[name] > 0:
             color = "%" + str(self.color_conf[name])
 
-        return color + self.style_conf[name]
+        r = color + self.style_conf[name]
+        self.codes[name] = r
+        return r
 
     def end(self, name):
-        return self._invert(self(name))
+        if name in self.end_codes:
+            return self.end_codes[name]
+
+        r = self._invert(self(name))
+        self.end_codes[name] = r
+        return r
+
+    # Formats that only depend on a few states (read, marked, selected...) can
+    # be compiled once per state combination. fn(*args) should return the
+    # fixed pieces of the format, with all of the codes already filled in,
+    # leaving the caller only the variable parts to fill. fn should be a
+    # module level function, it's part of the cache key.
+
+    def template(self, fn, *args):
+        key = (fn, args)
+        if key not in self.templates:
+            self.templates[key] = fn(*args)
+        return self.templates[key]
 
 cc = CantoColorManager()
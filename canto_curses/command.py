@@ -318,6 +318,8 @@ def cmd_execute(cmd):
 # syms - symbolics (i.e. { 'domain' : { '*' : all_items, '.' : [ current_item ]}})
 # fallback - list of items to return if no indices
 # s - input string to parse
+# key - optional function returning a hashable identity for an item, used to
+#       weed out duplicates (by default, items must be hashable themselves)
 
 # This is likely used lambda x: _int_range("mytype", {}, {}, x) to encapsulate the rest
 # of the state from the command infrastructure
@@ -347,7 +349,7 @@ def _int_check(x):
     except:
         return (False, None)
 
-def _int_range(name, itrs, syms, fallback, s):
+def _int_range(name, itrs, syms, fallback, s, key=None):
     s.strip()
 
     if (not s):
@@ -405,20 +407,29 @@ def _int_range(name, itrs, syms, fallback, s):
                 if item or ( item == '' and not fallback ):
                     log.warn("Invalid %s : '%s'" % (name, item))
 
-    # Strip down to unique indices
+    # Convert into list of unique items in itr, in order. Both indices and
+    # items are checked against sets, because things like 'item-state read *'
+    # can produce tens of thousands of them.
 
-    uidxlist = []
-    for tup in idxlist:
-        if tup not in uidxlist:
-            uidxlist.append(tup)
+    if not key:
+        key = lambda x : x
 
-    # Convert into list of items in itr
+    seen_idx = set()
+    seen = set()
 
     rlist = []
-    for domain, idx in uidxlist:
+    for tup in idxlist:
+        if tup in seen_idx:
+            continue
+        seen_idx.add(tup)
+
+        domain, idx = tup
         if 0 <= idx < len(itrs[domain]):
-            if itrs[domain][idx] not in rlist:
-                rlist.append(itrs[domain][idx])
+            item = itrs[domain][idx]
+            k = key(item)
+            if k not in seen:
+                seen.add(k)
+                rlist.append(item)
         else:
             log.warn("%s out of range of %s domain: %s idx with len %s" % (name, domain, idx, len(itrs[domain])))
 
@@ -48,7 +48,7 @@ eval_settings = [\
     ".*\\.window\\.(maxwidth|maxheight|float)",
     "color\\..*", "tag.(enumerated|collapsed|extra_tags)",
     "reader.(enumerate_links|show_description|show_enclosures)",
-    "taglist.(border|tags_enumerated|tags_enumerated_absolute|hide_empty_tags|search_attributes)",
+    "taglist.(border|tags_enumerated|tags_enumerated_absolute|hide_empty_tags|search_attributes|prelayout|pad_pool)",
     "taglist.cursor.edge",
     "story.(format_attrs|enumerated)"
 ]
@@ -85,6 +85,8 @@ class CantoCursesConfig(SubThread):
             "quiet" : False,
             "dispel_msg" : False,
             "input_prompt" : "",
+            "input_status" : "",
+            "commands_pending" : False,
             "input_do_completions" : True,
             "input_completion_root" : None,
             "input_completions" : [],
@@ -131,6 +133,7 @@ class CantoCursesConfig(SubThread):
                 "enumerate_links" : self.validate_bool,
                 "show_description" : self.validate_bool,
                 "show_enclosures" : self.validate_bool,
+                "attribute_cache" : self.validate_uint,
             },
 
             "taglist" :
@@ -141,8 +144,11 @@ class CantoCursesConfig(SubThread):
                 "tags_enumerated_absolute" : self.validate_bool,
                 "hide_empty_tags" : self.validate_bool,
                 "search_attributes" : self.validate_string_list,
+                "search_as_you_type" : self.validate_bool,
                 "cursor" : self.validate_taglist_cursor,
                 "border" : self.validate_bool,
+                "prelayout" : self.validate_uint,
+                "pad_pool" : self.validate_uint,
             },
 
             "story" :
@@ -211,6 +217,7 @@ class CantoCursesConfig(SubThread):
                 "enumerate_links" : False,
                 "show_description" : True,
                 "show_enclosures" : True,
+                "attribute_cache" : 16777216,
                 "key" :
                 {
                     "space" : "destroy",
@@ -247,6 +254,9 @@ class CantoCursesConfig(SubThread):
                 "hide_empty_tags" : True,
                 "border" : False,
                 "search_attributes" : [ "title" ],
+                "search_as_you_type" : False,
+                "prelayout" : 1,
+                "pad_pool" : 500,
 
                 "key" :
                 {
@@ -6,6 +6,7 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
+from canto_next.hooks import call_hook
 from canto_next.plugins import Plugin
 from canto_next.format import escsplit
 
@@ -93,6 +94,10 @@ class CantoCursesGui(CommandHandler):
 
         self.working = False
 
+        # Set while the input thread is handling a key, so idle work knows to
+        # get out of the way.
+        self.input_pending = False
+
         self.callbacks = {
             "set_var" : config.set_var,
             "get_var" : config.get_var,
@@ -148,6 +153,8 @@ class CantoCursesGui(CommandHandler):
         self.do_gui.set()
 
     def tick(self):
+        tag_updater.flush_attributes()
+
         c = self.callbacks["get_conf"]()
         if c["update"]["auto"]["enabled"]:
             self.sync_timer -= 1
@@ -196,6 +203,12 @@ class CantoCursesGui(CommandHandler):
     def run(self):
         while self.alive:
             r = self.screen.get_key()
+            self.input_pending = True
+
+            # Let anything running in the background (i.e. search) know that
+            # the user wants to get on with something else.
+
+            call_hook("curses_keypress", [r])
 
             # Get a list of all command handlers
             f = [self] + self.screen.get_focus_list()
@@ -213,6 +226,7 @@ class CantoCursesGui(CommandHandler):
                     self.callbacks["set_var"]("info_msg", "")
                     self.callbacks["set_var"]("dispel_msg", False)
                     self.release_gui()
+                self.input_pending = False
                 continue
 
             cmds = self.cmdsplit(cmd)
@@ -220,28 +234,58 @@ class CantoCursesGui(CommandHandler):
 
             # Now actually issue the commands
 
-            for cmd in cmds:
+            # Commands that usually work in the background (i.e. search)
+            # check commands_pending, so what follows them sees the result.
+
+            for i, cmd in enumerate(cmds):
 
                 okay = False
+                pending = i < len(cmds) - 1
 
                 # Command is our one hardcoded command because it's special, and also shouldn't invoke itself.
                 if cmd == "command":
                     subcmd = self.screen.input_callback(':')
                     log.debug("Got %s from user command", subcmd)
                     subcmds = self.cmdsplit(subcmd)
-                    for subcmd in subcmds:
+                    for j, subcmd in enumerate(subcmds):
+                        self.callbacks["set_var"]("commands_pending",\
+                                pending or j < len(subcmds) - 1)
                         okay = self.issue_cmd(subcmd)
                         if not okay:
                             break
                 else:
+                    self.callbacks["set_var"]("commands_pending", pending)
                     okay = self.issue_cmd(cmd)
 
                 if not okay:
                     break
 
+            self.callbacks["set_var"]("commands_pending", False)
+
             # Let the GUI thread process, or realize it's dead.
+            self.input_pending = False
             self.release_gui()
 
+    # While there's nothing else to do, let the windows lay out content that's
+    # just offscreen, so scrolling to it doesn't stall. This is done in small
+    # steps, dropping sync_lock in between, and stops as soon as a key comes
+    # in or anything else needs the GUI thread.
+
+    def prelayout(self):
+        while self.alive and not self.input_pending and not self.do_gui.is_set():
+            sync_lock.acquire_write()
+            try:
+                more = self.screen.prelayout()
+            except Exception as e:
+                log.error("Exception in prelayout: %s" % e)
+                log.error(traceback.format_exc())
+                more = False
+            finally:
+                sync_lock.release_write()
+
+            if not more:
+                break
+
     def run_gui(self):
         while True:
             self.do_gui.wait()
@@ -312,5 +356,13 @@ class CantoCursesGui(CommandHandler):
 
             sync_lock.release_write()
 
+            # Send any attribute requests this pass made (i.e. the reader
+            # wanting content) together.
+
+            tag_updater.flush_attributes()
+
+            if not self.working:
+                self.prelayout()
+
     def get_opt_name(self):
         return "main"
@@ -160,6 +160,12 @@ Common options:
     def die(self):
         unregister_all(self)
 
+    # Idle work, called repeatedly (with sync_lock) while the GUI thread has
+    # nothing better to do. Return True if there's more work left.
+
+    def prelayout(self):
+        return False
+
     # Provide completions, but we don't care to verify settings.
 
     def type_executable(self):
@@ -6,6 +6,7 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
+from canto_next.hooks import on_hook, unhook_all
 from canto_next.plugins import Plugin
 from .guibase import GuiBase
 from .widecurse import get_rlpoint
@@ -34,9 +35,26 @@ class InputBox(GuiBase):
 
         self.reset()
 
+        on_hook("curses_var_change", self.on_var_change, self)
+
+    def die(self):
+        unhook_all(self)
+        GuiBase.die(self)
+
+    # When we're not prompting, show the input_status line instead (e.g.
+    # search progress).
+
+    def on_var_change(self, change):
+        if "input_status" in change and not self.callbacks["get_var"]("input_prompt"):
+            self.reset()
+            self.callbacks["set_var"]("needs_refresh", True)
+
     def reset(self):
         self.pad.erase()
-        self.pad.addstr(self.callbacks["get_var"]("input_prompt"))
+        prompt = self.callbacks["get_var"]("input_prompt")
+        if not prompt:
+            prompt = self.callbacks["get_var"]("input_status")
+        self.pad.addstr(prompt)
         self.minx = self.pad.getyx()[1]
         self.x = self.minx
         self.content = readline.get_line_buffer()
@@ -115,11 +115,13 @@ class Reader(TextBox):
 
             for attr in l:
                 if attr not in sel.content:
-                    tag_updater.request_attributes(sel.id, l)
+                    tag_updater.fetch_attributes(sel.id, l)
                     s += "%BWaiting for content...%b\n"
                     on_hook("curses_attributes", self.on_attributes, self)
                     break
             else:
+                tag_updater.touch_attributes(sel.id)
+
                 # Grab text content over description, as it's likely got more
                 # information.
 
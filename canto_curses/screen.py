@@ -66,6 +66,8 @@ class Screen(CommandHandler):
         self.pseudo_input_box.keypad(1)
         self.pseudo_input_box.nodelay(1)
         self.input_lock = Lock()
+        self.input_on_change = None
+        self.input_last = ""
 
         set_redisplay_callback(self.readline_redisplay)
         set_getc(self.readline_getc)
@@ -543,10 +545,17 @@ Arguments:"""),
             b = min(b, t + c.pad.getyx()[0])
         c.pad.noutrefresh(0, 0, t, l, b, r)
 
-    def input_callback(self, prompt, completions=True):
+    # If on_change is given, it's called with the line so far whenever it
+    # changes, and the windows are redrawn afterwards so the user sees the
+    # effect as they type (i.e. search-as-you-type).
+
+    def input_callback(self, prompt, completions=True, on_change=None):
         # Setup subedit
         self.curs_set(1)
 
+        self.input_on_change = on_change
+        self.input_last = ""
+
         self.callbacks["set_var"]("input_do_completions", completions)
         self.callbacks["set_var"]("input_prompt", prompt)
 
@@ -561,6 +570,7 @@ Arguments:"""),
             r = ""
 
         self.pseudo_input_box.keypad(1)
+        self.input_on_change = None
 
         # Only add history for commands, not other prompts
         if completions:
@@ -642,6 +652,13 @@ Arguments:"""),
         sync_lock.release_write()
 
     def _readline_redisplay(self):
+        if self.input_on_change:
+            buf = readline.get_line_buffer()
+            if buf != self.input_last:
+                self.input_last = buf
+                self.input_on_change(buf)
+                self.redraw()
+
         self.input_box.refresh()
         curses.doupdate()
 
@@ -696,6 +713,15 @@ Arguments:"""),
             c.redraw()
         curses.doupdate()
 
+    # Hand idle time to the windows, one small piece of work at a time.
+    # Returns True if any window has more work to do.
+
+    def prelayout(self):
+        for c in self.tiles + self.floats:
+            if c.prelayout():
+                return True
+        return False
+
     # Typical curses resize, endwin and re-setup.
     def resize(self):
         try:
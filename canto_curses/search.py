@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#Canto-curses - ncurses RSS reader
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+import logging
+
+log = logging.getLogger("SEARCH")
+
+# Get the literal strings that any match of regex must contain, so we can
+# use them to narrow down candidates before running the real regex. This is
+# conservative, anything it doesn't understand just doesn't contribute a
+# literal, and an empty list means every item is a candidate.
+
+def regex_literals(regex):
+    # Alternation means nothing is required, and inline flags might make
+    # literals case insensitive.
+
+    if "|" in regex or "(?" in regex:
+        return []
+
+    literals = []
+    run = ""
+    depth = 0
+    i = 0
+
+    while i < len(regex):
+        c = regex[i]
+
+        if c == "\\" and i + 1 < len(regex):
+            i += 1
+            c = regex[i]
+
+            # Classes (\w, \d, ...) and backrefs break a run, escaped
+            # punctuation is literal.
+
+            if c.isalnum():
+                literals.append(run)
+                run = ""
+            elif depth == 0:
+                run += c
+
+        elif c == "[":
+            literals.append(run)
+            run = ""
+
+            # Skip the class, a leading ] (or ^]) is part of it.
+
+            i += 1
+            if i < len(regex) and regex[i] == "^":
+                i += 1
+            if i < len(regex) and regex[i] == "]":
+                i += 1
+            while i < len(regex) and regex[i] != "]":
+                if regex[i] == "\\":
+                    i += 1
+                i += 1
+
+        # Group contents might be optional, so ignore them.
+
+        elif c == "(":
+            literals.append(run)
+            run = ""
+            depth += 1
+        elif c == ")":
+            depth -= 1
+
+        # These make the previous character optional.
+
+        elif c in "*?{":
+            run = run[:-1]
+            literals.append(run)
+            run = ""
+
+            if c == "{":
+                while i < len(regex) and regex[i] != "}":
+                    i += 1
+
+        elif c in ".^$+":
+            literals.append(run)
+            run = ""
+
+        elif depth == 0:
+            run += c
+
+        i += 1
+
+    literals.append(run)
+    return [ l for l in literals if l ]
+
+def ngrams(s, n):
+    return set([ s[i:i + n] for i in range(len(s) - n + 1) ])
+
+# An inverted index over the search attributes of items. Every value is
+# indexed by trigram, and by bigram, so the first keystrokes of a search
+# can be narrowed down too. Single characters aren't indexed, nearly every
+# item would be a candidate anyway.
+
+class SearchIndex(object):
+    def __init__(self, attrs):
+        self.attrs = attrs[:]
+
+        # id -> [ values ]
+        self.docs = {}
+
+        # gram -> set([ ids ])
+        self.trigrams = {}
+        self.bigrams = {}
+
+    def _postings(self, values):
+        tris = set()
+        bis = set()
+        for v in values:
+            tris.update(ngrams(v, 3))
+            bis.update(ngrams(v, 2))
+        return (tris, bis)
+
+    def _add(self, index, grams, id):
+        for gram in grams:
+            if gram in index:
+                index[gram].add(id)
+            else:
+                index[gram] = set([ id ])
+
+    def _discard(self, index, grams, id):
+        for gram in grams:
+            index[gram].discard(id)
+            if not index[gram]:
+                del index[gram]
+
+    def update(self, id, attributes):
+        values = [ attributes[a] for a in self.attrs\
+                if a in attributes and type(attributes[a]) == str ]
+
+        if id in self.docs:
+            if self.docs[id] == values:
+                return
+            self.remove(id)
+
+        if not values:
+            return
+
+        self.docs[id] = values
+
+        tris, bis = self._postings(values)
+        self._add(self.trigrams, tris, id)
+        self._add(self.bigrams, bis, id)
+
+    def remove(self, id):
+        if id not in self.docs:
+            return
+
+        tris, bis = self._postings(self.docs[id])
+        del self.docs[id]
+
+        self._discard(self.trigrams, tris, id)
+        self._discard(self.bigrams, bis, id)
+
+    # The ids that could contain literal, or None if the index can't tell.
+
+    def _candidates(self, literal):
+        if len(literal) == 2:
+            if literal not in self.bigrams:
+                return set()
+            return set(self.bigrams[literal])
+
+        if len(literal) < 3:
+            return None
+
+        sets = []
+        for tri in ngrams(literal, 3):
+            if tri not in self.trigrams:
+                return set()
+            sets.append(self.trigrams[tri])
+
+        sets.sort(key=len)
+        r = set(sets[0])
+        for s in sets[1:]:
+            r &= s
+        return r
+
+    # Return the ids that could match, given that a match must contain all of
+    # literals. If within is given, only ids in it are considered, which is
+    # how a search narrows the results of a previous one.
+
+    def candidates(self, literals, within=None):
+        candidates = None
+
+        for literal in literals:
+            c = self._candidates(literal)
+            if c == None:
+                continue
+            if candidates == None:
+                candidates = c
+            else:
+                candidates &= c
+
+        if within != None:
+            if candidates == None:
+                candidates = set(within)
+            else:
+                candidates &= within
+
+        if candidates == None:
+            candidates = self.docs.keys()
+
+        log.debug("Searching %d of %d items", len(candidates), len(self.docs))
+        return list(candidates)
+
+    # Return the set of ids, out of ids, with a search attribute matching the
+    # compiled regex rgx.
+
+    def match(self, rgx, ids):
+        matches = set()
+        for id in ids:
+            if id not in self.docs:
+                continue
+            for v in self.docs[id]:
+                if rgx.match(v):
+                    matches.add(id)
+                    break
+
+        return matches
+
+    def search(self, rgx, literals, within=None):
+        return self.match(rgx, self.candidates(literals, within))
@@ -7,10 +7,10 @@
 #   published by the Free Software Foundation.
 
 from canto_next.plugins import Plugin, PluginHandler
-from canto_next.hooks import on_hook, unhook_all
+from canto_next.hooks import call_hook, on_hook, unhook_all
 
-from .theme import FakePad, WrapPad, theme_print, theme_len, theme_reset, theme_border, prep_for_display
-from .tagcore import tag_updater
+from .theme import FakePad, WrapPad, LayoutCache, ThemeContext, theme_print, theme_print_at, theme_len, theme_border, prep_for_display
+from .tagcore import tag_updater, Attributes
 from .config import story_needed_attrs
 from .color import cc
 
@@ -23,6 +23,30 @@ log = logging.getLogger("STORY")
 class StoryPlugin(Plugin):
     pass
 
+# The default story format, compiled by cc.template into the text before and
+# after the title.
+
+def story_format(read, marked, selected):
+    pre = ""
+    post = ""
+
+    if read:
+        pre += cc("read")
+        post = cc.end("read") + post
+    else:
+        pre += cc("unread")
+        post = cc.end("unread") + post
+
+    if marked:
+        pre += cc("marked") + "[*]"
+        post = cc.end("marked") + post
+
+    if selected:
+        pre += cc("selected")
+        post = cc.end("selected") + post
+
+    return (pre, post)
+
 # The Story class is the basic wrapper for an item to be displayed. It manages
 # its own state only because it affects its representation, it's up to a higher
 # class to actually communicate state changes to the backend.
@@ -63,25 +87,93 @@ class Story(PluginHandler):
         self.enumerated = False
         self.rel_enumerated = False
 
+        self.new_content = None
+
+        # The (read, canto-tags) state our Tag last counted us with.
+        self.counted = None
+
+        self.plugin_class = StoryPlugin
+
+        # Tags create a Story for every item, but most will never be drawn
+        # or used by a command. Until one is, it's just a placeholder with an
+        # id and a place in the list, and its content, layouts, hooks and
+        # plugins are only set up when something asks for them.
+        self.materialized = False
+
+    def materialize(self):
+        if self.materialized:
+            return
+
+        # A dead story gets no hooks or subscription, since die() has already
+        # been called and nothing would remove them. Just give anything still
+        # holding it something to read.
+
+        if self.is_dead:
+            self.layouts = LayoutCache()
+            self.content = tag_updater.get_attributes(self.id)
+            return
+
+        self.materialized = True
+
+        self.layouts = LayoutCache()
+
         # This should exist before the hook is setup, or the hook will fail.
-        self.content = {}
+        self.content = Attributes()
 
         on_hook("curses_opt_change", self.on_opt_change, self)
         on_hook("curses_tag_opt_change", self.on_tag_opt_change, self)
-        on_hook("curses_attributes", self.on_attributes, self)
+        tag_updater.subscribe([ self.id ], self.on_attributes)
 
-        # Grab initial content, if any, the rest will be handled by the
-        # attributes hook
+        # Grab initial content, if any, the rest will be handled by
+        # on_attributes
 
         self.content = tag_updater.get_attributes(self.id)
-        self.new_content = None
 
-        self.plugin_class = StoryPlugin
         self.update_plugin_lookups()
 
+    def __getattr__(self, name):
+        if name in [ "content", "layouts" ] and not self.materialized:
+            self.materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def die(self):
         self.is_dead = True
-        unhook_all(self)
+        if self.materialized:
+            self.layouts.clear()
+            unhook_all(self)
+            tag_updater.unsubscribe([ self.id ], self.on_attributes)
+
+    # Our content for reading or changing state (read, canto-tags) without
+    # materializing a placeholder just for that. A placeholder gets
+    # tag_updater's copy, which is what it'll have once it's materialized.
+
+    def state_content(self):
+        if self.materialized:
+            return self.content
+        return tag_updater.get_attributes(self.id)
+
+    def is_read(self):
+        content = self.state_content()
+        return "canto-state" in content and "read" in content["canto-state"]
+
+    def count_state(self):
+        content = self.state_content()
+        read = "canto-state" in content and "read" in content["canto-state"]
+
+        tags = ()
+        if "canto-tags" in content and content["canto-tags"]:
+            tags = tuple(content["canto-tags"])
+
+        return (read, tags)
+
+    # Whether we have the content needed to render, without syncing.
+
+    def ready(self):
+        for attr in story_needed_attrs:
+            if attr not in self.content:
+                return False
+        return True
 
     def __eq__(self, other):
         if not other:
@@ -93,15 +185,17 @@ class Story(PluginHandler):
     def __str__(self):
         return "story: %s" % self.id
 
-    # On_attributes updates new_content. We don't lock because we don't
-    # particularly care what version of new_content the next sync() call gets.
+    # On_attributes updates new_content, and tells our Tag we need a sync().
+    # We don't lock because we don't particularly care what version of
+    # new_content the next sync() call gets.
 
     def on_attributes(self, attributes):
         if self.id in attributes:
             new_content = attributes[self.id]
 
-            if not (new_content is self.content):
+            if new_content.version != self.content.version:
                 self.new_content = new_content
+                self.parent_tag.unsynced[self.id] = self
 
     def sync(self):
         if self.new_content == None:
@@ -119,6 +213,7 @@ class Story(PluginHandler):
             self.content['canto-tags'] = old_content['canto-tags']
             self.fresh_tags = False
 
+        self.callbacks["item_state_change"](self)
         self.need_redraw()
 
     def on_opt_change(self, config):
@@ -152,16 +247,18 @@ class Story(PluginHandler):
     # Add / remove state. Return True if an actual change, False otherwise.
 
     def _handle_key(self, attr, key):
-        if key not in self.content or self.content[key] == "":
-            self.content[key] = []
+        content = self.state_content()
+
+        if key not in content or content[key] == "":
+            content[key] = []
 
         # Negative attribute
         if attr[0] == "-":
             attr = attr[1:]
             if attr == "marked":
                 return self.unmark()
-            elif attr in self.content[key]:
-                self.content[key].remove(attr)
+            elif attr in content[key]:
+                content[key].remove(attr)
                 self.need_redraw()
                 return True
 
@@ -174,10 +271,10 @@ class Story(PluginHandler):
                 else:
                     self.mark()
             else:
-                if attr in self.content[key]:
-                    self.content[key].remove(attr)
+                if attr in content[key]:
+                    content[key].remove(attr)
                 else:
-                    self.content[key].append(attr)
+                    content[key].append(attr)
                 self.need_redraw()
                 return True
 
@@ -185,8 +282,8 @@ class Story(PluginHandler):
         else:
             if attr == "marked":
                 return self.mark()
-            elif attr not in self.content[key]:
-                self.content[key].append(attr)
+            elif attr not in content[key]:
+                content[key].append(attr)
                 self.need_redraw()
                 return True
         return False
@@ -222,6 +319,7 @@ class Story(PluginHandler):
         if not self.marked:
             self.marked = True
             self.need_redraw()
+            call_hook("curses_story_marked", [ self, True ])
             return True
         return False
 
@@ -229,6 +327,7 @@ class Story(PluginHandler):
         if self.marked:
             self.marked = False
             self.need_redraw()
+            call_hook("curses_story_marked", [ self, False ])
             return True
         return False
 
@@ -257,37 +356,37 @@ class Story(PluginHandler):
         self.callbacks["set_var"]("needs_refresh", True)
 
     def eval(self):
-        s = ""
+        read = "read" in self.content["canto-state"]
+        pre, post = cc.template(story_format, read, self.marked, self.selected)
+        return pre + prep_for_display(self.content["title"]) + post
 
-        if "read" in self.content["canto-state"]:
-            s += cc("read")
-        else:
-            s += cc("unread")
+    # Our lines at width, including any (i.e. the tag footer) the taglist put
+    # after us.
 
-        if self.marked:
-            s += cc("marked") + "[*]"
+    def lines(self, width):
+        if width != self.width or self.changed:
+            self.layout(width)
+        return self.lns + self.extra_lines
 
-        if self.selected:
-            s += cc("selected")
+    # Lay out at width, and return the layout. Layouts belong to self.layouts,
+    # and so to the global layout_lru, so we don't hold onto one here or they
+    # couldn't be evicted.
 
-        s += prep_for_display(self.content["title"])
+    def layout(self, width):
 
-        if self.selected:
-            s += cc.end("selected")
+        # Any change invalidates layouts at every width, otherwise we may have
+        # been laid out at this width before.
 
-        if self.marked:
-            s += cc.end("marked")
-
-        if "read" in self.content["canto-state"]:
-            s += cc.end("read")
+        if self.changed:
+            self.layouts.clear()
         else:
-            s += cc.end("unread")
-
-        return s
-
-    def lines(self, width):
-        if width == self.width and not self.changed:
-            return self.lns + self.extra_lines
+            cached = self.layouts.get(width)
+            if cached:
+                layout, self.lns = cached
+                if width != self.width:
+                    self.pad = None
+                    self.width = width
+                return layout
 
         # Make sure we actually have all of the attributes needed
         # to complete the render.
@@ -313,8 +412,11 @@ class Story(PluginHandler):
 
                 self.evald_string = "Waiting on content..."
 
+                layout = FakePad(width)
+                self.render(layout, width, ThemeContext())
+
                 self.lns = 1
-                return self.lns
+                return layout
 
         for attr in list(self.plugin_attrs.keys()):
             if not attr.startswith("edit_"):
@@ -342,24 +444,37 @@ class Story(PluginHandler):
         self.width = width
         self.changed = False
 
-        self.lns = self.render(FakePad(width), width)
-        return self.lns
+        layout = FakePad(width)
+        self.lns = self.render(layout, width, ThemeContext())
+
+        self.layouts.put(width, (layout, self.lns), len(layout.ops))
+        return layout
+
+    # Paint our layout onto a real pad, laying out again if it's been evicted.
 
     def pads(self, width):
-        if self.pad and not self.changed:
+        if self.pad and not self.changed and width == self.width:
             return self.lns
 
-        self.pad = curses.newpad(self.lines(width), width)
-        self.render(WrapPad(self.pad), width)
+        layout = self.layout(width)
+
+        self.pad = curses.newpad(self.lns, width)
+        layout.replay(WrapPad(self.pad))
         return self.lns
 
-    def render(self, pad, width):
+    # Release our pad, the next pads() call will replay the layout.
+
+    def unpad(self):
+        self.pad = None
+
+    def render(self, pad, width, ctx):
         s = self.evald_string
 
         lines = 0
 
         try:
-            while s:
+            pos = 0 if s else None
+            while pos != None:
                 # Left border, for first line
                 if lines == 0:
                     l = self.left
@@ -368,7 +483,7 @@ class Story(PluginHandler):
                 else:
                     l = self.left_more
 
-                s = theme_print(pad, s, width, l, self.right)
+                pos = theme_print_at(pad, ctx, s, pos, width, l, self.right)
 
                 # Handle overwriting with offset information
 
@@ -380,7 +495,7 @@ class Story(PluginHandler):
                         header += cc("enum_hints") + "[" + str(self.rel_offset) + "]%0"
                     if header:
                         pad.move(0, 0)
-                        theme_print(pad, header, width, "","", False, False)
+                        theme_print(pad, ctx, header, width, "","", False, False)
                         try:
                             pad.move(1, 0)
                         except:
@@ -398,6 +513,6 @@ class Story(PluginHandler):
             log.debug("\n" + "".join(tb))
 
         # Reset theme counters
-        theme_reset()
+        ctx.reset()
 
         return lines
@@ -11,8 +11,9 @@ from canto_next.plugins import Plugin, PluginHandler
 from canto_next.rwlock import read_lock
 
 from .locks import sync_lock, config_lock
-from .theme import FakePad, WrapPad, theme_print, theme_reset, theme_border, prep_for_display
+from .theme import FakePad, WrapPad, LayoutCache, ThemeContext, theme_print, theme_print_at, theme_border, prep_for_display
 from .config import config
+from .tagcore import tag_updater
 from .story import Story
 from .color import cc
 
@@ -31,8 +32,39 @@ log = logging.getLogger("TAG")
 class TagPlugin(Plugin):
     pass
 
+# The default tag header format, compiled by cc.template into the pieces
+# around the tag name, unread count and (if any) pending count.
+
+def tag_format(selected, collapsed, pending):
+    head = ""
+    tail = ""
+
+    if selected:
+        head += cc("selected")
+        tail = cc.end("selected")
+
+    if collapsed:
+        head += "[+] "
+    else:
+        head += "[-] "
+
+    mid = " [" + cc("unread")
+    unread_end = cc.end("unread") + "]"
+
+    if pending:
+        return (head, mid, unread_end + " [" + cc("pending"),
+                cc.end("pending") + "]" + tail)
+
+    return (head, mid, unread_end + tail)
+
 alltags = []
 
+# Unread stories across all tags (a story in more than one tag is counted in
+# each of them).
+
+def unread_total():
+    return sum([ tag.unread_count for tag in alltags ])
+
 class Tag(PluginHandler, list):
     def __init__(self, tagcore, callbacks):
         list.__init__(self)
@@ -79,6 +111,7 @@ class Tag(PluginHandler, list):
         self.footlines = 0
         self.extra_lines = 0
         self.width = 0
+        self.layouts = LayoutCache()
 
         self.collapsed = False
         self.border = False
@@ -95,9 +128,23 @@ class Tag(PluginHandler, list):
         self.tag_offset = -1
         self.sel_offset = -1
 
+        # Unread and read stories, and the number of stories with each
+        # canto-tag, kept up to date as stories come, go, and change state,
+        # so themes don't have to count them for every header.
+        self.unread_count = 0
+        self.read_count = 0
+        self.tag_counts = {}
+
+        # Our stories by id, and the ids that tag_updater has told us have
+        # new attributes, but haven't been recounted yet.
+        self.id_map = {}
+        self.recount_ids = set()
+
+        # Stories with new content waiting for sync(), by id.
+        self.unsynced = {}
+
         on_hook("curses_opt_change", self.on_opt_change, self)
         on_hook("curses_tag_opt_change", self.on_tag_opt_change, self)
-        on_hook("curses_attributes", self.on_attributes, self)
         on_hook("curses_items_added", self.on_items_added, self)
 
         # Upon creation, this Tag adds itself to the
@@ -113,17 +160,59 @@ class Tag(PluginHandler, list):
         # Reset so items get die() called and everything
         # else is notified about items disappearing.
 
+        tag_updater.unsubscribe(self.get_ids(), self.on_attributes)
+
         for s in self:
             s.die()
         del self[:]
 
+        self.id_map = {}
+        self.unsynced = {}
+        self.unread_count = 0
+        self.read_count = 0
+        self.tag_counts = {}
+
         alltags.remove(self)
 
+        self.layouts.clear()
         unhook_all(self)
 
     def on_item_state_change(self, item):
+        self.recount(item)
         self.need_redraw()
 
+    def _count(self, story, n):
+        if story.counted == None:
+            return
+
+        read, tags = story.counted
+        if read:
+            self.read_count += n
+        else:
+            self.unread_count += n
+
+        for tag in tags:
+            count = self.tag_counts.get(tag, 0) + n
+            if count:
+                self.tag_counts[tag] = count
+            else:
+                del self.tag_counts[tag]
+
+    def recount(self, story):
+        state = story.count_state()
+        if state != story.counted:
+            self._count(story, -1)
+            story.counted = state
+            self._count(story, 1)
+
+    # Called with sync_lock, before the counts are used.
+
+    def recount_pending(self):
+        while self.recount_ids:
+            story = self.id_map.get(self.recount_ids.pop())
+            if story is not None:
+                self.recount(story)
+
     def on_opt_change(self, opts):
         if "taglist" in opts and\
                 ("tags_enumerated" in opts["taglist"] or\
@@ -145,21 +234,17 @@ class Tag(PluginHandler, list):
             else:
                 self.need_redraw()
 
-    # Technically, we might want to hold sync_lock so that self[:] doesn't
-    # change, but if we're syncing, the setting of needs_redraw isn't important
-    # anymore, and if we're not, there's no issue.
+    # Called by tag_updater with the changed attributes of our stories. This
+    # isn't with sync_lock, so just note which stories need to be recounted.
 
     def on_attributes(self, attributes):
-        for s in self:
-            if s.id in attributes:
-                self.need_redraw()
-                break
+        self.recount_ids.update(attributes.keys())
+        self.need_redraw()
 
     def on_items_added(self, tagcore, added):
-        if tagcore == self.tagcore:
-            cur_ids = self.get_ids()
+        if tagcore is self.tagcore:
             for story_id in added:
-                if story_id not in cur_ids:
+                if story_id not in self.id_map:
                     self.updates_pending += 1
             self.need_redraw()
 
@@ -175,9 +260,7 @@ class Tag(PluginHandler, list):
         return "%s" % self.tag[self.tag.index(':') + 1:]
 
     def get_id(self, id):
-        for item in self:
-            if item.id == id:
-                return item
+        return self.id_map.get(id)
 
     def get_ids(self):
         return [ s.id for s in self ]
@@ -238,33 +321,37 @@ class Tag(PluginHandler, list):
         # Make sure to strip out the category from category:name
         tag = self.tag.split(':', 1)[1]
 
-        unread = len([s for s in self\
-                if "canto-state" not in s.content or\
-                "read" not in s.content["canto-state"]])
-
-        s = ""
-        if self.selected:
-            s += cc("selected")
-
-        if self.collapsed:
-            s += "[+]"
-        else:
-            s += "[-]"
+        fmt = cc.template(tag_format, self.selected, self.collapsed,
+                self.updates_pending > 0)
 
-        s += " " + tag + " "
-
-        s += "[" + cc("unread") + str(unread) + cc.end("unread") + "]"
+        s = fmt[0] + tag + fmt[1] + str(self.unread_count) + fmt[2]
         if self.updates_pending:
-            s += " [" + cc("pending") + str(self.updates_pending) + cc.end("pending") + "]"
-
-        if self.selected:
-            s += cc.end("selected")
+            s += str(self.updates_pending) + fmt[3]
 
         return s
 
     def lines(self, width):
-        if width == self.width and not self.changed:
-            return self.lns
+        if width != self.width or self.changed:
+            self.layout(width)
+        return self.lns
+
+    # Lay out at width, and return the header and footer layouts. Like
+    # stories, these belong to self.layouts so they can be evicted.
+
+    def layout(self, width):
+        self.recount_pending()
+
+        if self.changed:
+            self.layouts.clear()
+        else:
+            cached = self.layouts.get(width)
+            if cached:
+                layout, footlayout, self.lns, self.footlines = cached
+                if width != self.width:
+                    self.pad = None
+                    self.footpad = None
+                    self.width = width
+                return (layout, footlayout)
 
         taglist_conf = self.callbacks["get_opt"]("taglist")
 
@@ -282,30 +369,49 @@ class Tag(PluginHandler, list):
 
         self.evald_string = self.eval()
 
-        self.lns = self.render_header(width, FakePad(width))
-        self.footlines = self.render_footer(width, FakePad(width))
+        layout = FakePad(width)
+        footlayout = FakePad(width)
 
-        return self.lns
+        self.lns = self.render_header(width, layout, ThemeContext())
+        self.footlines = self.render_footer(width, footlayout, ThemeContext())
+
+        self.layouts.put(width, (layout, footlayout, self.lns, self.footlines),
+                len(layout.ops) + len(footlayout.ops))
+
+        return (layout, footlayout)
+
+    # Paint the layouts onto real pads, laying out again if they've been
+    # evicted.
 
     def pads(self, width):
-        if self.pad and (self.footpad or not self.footlines) and not self.changed:
+        if self.pad and (self.footpad or not self.footlines) and\
+                not self.changed and width == self.width:
             return self.lns
 
-        self.pad = curses.newpad(self.lines(width), width)
-        self.render_header(width, WrapPad(self.pad))
+        layout, footlayout = self.layout(width)
+
+        self.pad = curses.newpad(self.lns, width)
+        layout.replay(WrapPad(self.pad))
 
         if self.footlines:
             self.footpad = curses.newpad(self.footlines, width)
-            self.render_footer(width, WrapPad(self.footpad))
+            footlayout.replay(WrapPad(self.footpad))
         return self.lns
 
-    def render_header(self, width, pad):
+    # Release our pads, the next pads() call will replay the layouts.
+
+    def unpad(self):
+        self.pad = None
+        self.footpad = None
+
+    def render_header(self, width, pad, ctx):
         s = self.evald_string
         lines = 0
 
         try:
-            while s:
-                s = theme_print(pad, s, width, "", "")
+            pos = 0 if s else None
+            while pos != None:
+                pos = theme_print_at(pad, ctx, s, pos, width, "", "")
 
                 if lines == 0:
                     header = ""
@@ -315,7 +421,7 @@ class Tag(PluginHandler, list):
                         header += cc("enum_hints") + "[" + str(self.tag_offset) + "]%0"
                     if header:
                         pad.move(0, 0)
-                        theme_print(pad, header, width, "", "", False, False)
+                        theme_print(pad, ctx, header, width, "", "", False, False)
                         try:
                             pad.move(1, 0)
                         except:
@@ -323,7 +429,7 @@ class Tag(PluginHandler, list):
                 lines += 1
 
             if not self.collapsed and self.border:
-                theme_print(pad, theme_border("ts") * (width - 2), width,\
+                theme_print(pad, ctx, theme_border("ts") * (width - 2), width,\
                         "%B"+ theme_border("tl"), theme_border("tr") + "%b")
                 lines += 1
         except Exception as e:
@@ -331,15 +437,15 @@ class Tag(PluginHandler, list):
             log.debug("Tag exception:")
             log.debug("\n" + "".join(tb))
 
-        theme_reset()
+        ctx.reset()
 
         return lines
 
-    def render_footer(self, width, pad):
+    def render_footer(self, width, pad, ctx):
         if not self.collapsed and self.border:
-            theme_print(pad, theme_border("bs") * (width - 2), width,\
+            theme_print(pad, ctx, theme_border("bs") * (width - 2), width,\
                     "%B" + theme_border("bl"), theme_border("br") + "%b")
-            theme_reset()
+            ctx.reset()
             return 1
         return 0
 
@@ -349,71 +455,78 @@ class Tag(PluginHandler, list):
         if force or self.tagcore.changes:
             sel = self.callbacks["get_var"]("selected")
 
+            # Reconcile with the TagCore through our id map, so this is linear
+            # in the size of the tag, and only the stories that come or go
+            # are created or destroyed. With the TagCore locked, we only need
+            # a copy of its ids and to find the stories it no longer has.
+
             self.tagcore.lock.acquire_read()
 
             self.tagcore.ack_changes()
 
-            # Get sorted ids, along with their (unsorted) positions in the
-            # original lists.
-
-            sorted_ids = [ (x, x.id, i) for (i, x) in enumerate(self) ]
-            sorted_ids.sort(key=lambda x: x[1])
-
-            tagcore_sorted_ids = list(enumerate(self.tagcore))
-            tagcore_sorted_ids.sort(key=lambda x: x[1])
+            # Positions are keyed by id, in order, without duplicates.
+            ids = list(self.tagcore.positions)
 
-            new_ids = []
-            current_stories = []
+            undead = []
             old_stories = []
 
-            for story, s_id, place in sorted_ids:
-                while tagcore_sorted_ids and s_id > tagcore_sorted_ids[0][1]:
-                    new_ids.append(tagcore_sorted_ids.pop(0))
+            for story in self:
+                if story.id in self.tagcore:
+                    continue
 
-                if not tagcore_sorted_ids or s_id < tagcore_sorted_ids[0][1]:
-                    if sel and (not sel.is_tag) and (s_id == sel.id):
+                if sel and (not sel.is_tag) and (story.id == sel.id):
 
-                        # If we preserve the selection in an "undead" state, then
-                        # we keep set tagcore changed so that the next sync operation
-                        # will re-evaluate it.
+                    # If we preserve the selection in an "undead" state, then
+                    # we keep set tagcore changed so that the next sync operation
+                    # will re-evaluate it.
 
-                        self.tagcore.changed()
-                        place = -1
-                        current_stories.append((place, story))
-                    else:
-                        old_stories.append(story)
+                    self.tagcore.changed()
+                    undead.append(story)
                 else:
-                    place = tagcore_sorted_ids.pop(0)[0]
-                    current_stories.append((place, story))
-
-            # Grab any remaining new items
-            new_ids += tagcore_sorted_ids
+                    old_stories.append(story)
 
             self.tagcore.lock.release_read()
 
-            new_stories = [ (p, Story(self, x, self.callbacks)) for (p, x) in new_ids ]
+            for story in old_stories:
+                if self.id_map.get(story.id) is story:
+                    del self.id_map[story.id]
+
+            # Walk the TagCore's ids, in order, picking up the stories we have
+            # and creating the rest.
+
+            new_stories = []
+            kept_stories = []
+            all_stories = []
+
+            for id in ids:
+                story = self.id_map.get(id)
+                if story is None:
+                    story = Story(self, id, self.callbacks)
+                    self.id_map[id] = story
+                    new_stories.append(story)
+                    self.recount(story)
+                else:
+                    kept_stories.append(story)
+                all_stories.append(story)
 
-            call_hook("curses_stories_added", [ self, [ x for (p, x) in new_stories ]])
+            tag_updater.subscribe([ x.id for x in new_stories ], self.on_attributes)
 
-            del self[:]
+            call_hook("curses_stories_added", [ self, new_stories ])
 
             conf = config.get_conf()
             if conf["update"]["style"] == "maintain" or self.tagcore.was_reset:
                 self.tagcore.was_reset = False
-                current_stories += new_stories
-                current_stories.sort()
-                self.extend([ x[1] for x in current_stories ])
+                self[:] = undead + all_stories
+            elif conf["update"]["style"] == "append":
+                self[:] = undead + kept_stories + new_stories
             else:
-                current_stories.sort()
-                new_stories.sort()
-                if conf["update"]["style"] == "append":
-                    current_stories += new_stories
-                    self.extend([ x[1] for x in current_stories ])
-                else:
-                    new_stories += current_stories
-                    self.extend([ x[1] for x in new_stories ])
+                self[:] = new_stories + undead + kept_stories
+
+            tag_updater.unsubscribe([ x.id for x in old_stories ], self.on_attributes)
 
             for story in old_stories:
+                self.unsynced.pop(story.id, None)
+                self._count(story, -1)
                 story.die()
 
             # Properly dispose of the remaining stories
@@ -425,8 +538,11 @@ class Tag(PluginHandler, list):
 
             self.need_refresh()
 
-        # Pass the sync onto story objects
-        for s in self:
-            s.sync()
+        # Pass the sync onto the story objects that have new content.
+        while self.unsynced:
+            id, story = self.unsynced.popitem()
+            story.sync()
+
+        self.recount_pending()
 
         self.updates_pending = 0
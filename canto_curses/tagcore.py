@@ -12,19 +12,135 @@ from canto_next.hooks import call_hook, on_hook
 from .subthread import SubThread
 from .locks import config_lock
 from .config import config, story_needed_attrs
+from .search import SearchIndex
 
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import itertools
 import traceback
+import time
 import logging
 
 log = logging.getLogger("TAGCORE")
 
+# Rough size of an attribute value in bytes (well, characters), for keeping
+# the attribute cache within bounds.
+
+def attr_size(value):
+    if type(value) == str:
+        return len(value)
+    if type(value) == dict:
+        return sum([ attr_size(k) + attr_size(v) for (k, v) in value.items() ])
+    if type(value) in [ list, tuple ]:
+        return sum([ attr_size(v) for v in value ])
+    return 8
+
+# Attributes that change all the time (i.e. every time an item is read) and are
+# kept apart from the rest so changing them doesn't mean copying the rest.
+
+HOT_ATTRS = [ "canto-state", "canto-tags" ]
+
+attr_versions = itertools.count(1)
+
+# The attributes of an item. The TagUpdater replaces, rather than updates,
+# these as changes arrive, so a Story can keep using the one it has until it
+# syncs. A replacement copies only the half (hot or not) that changed, and
+# shares the other, and every one has a new version, so whether a Story is
+# out of date is a comparison of versions.
+#
+# Otherwise this behaves like the dict it used to be, including setting
+# attributes in place, which stories do to reflect local state changes before
+# the daemon does.
+
+class Attributes(MutableMapping):
+    __slots__ = [ "hot", "rest", "version" ]
+
+    def __init__(self, hot=None, rest=None, version=0):
+        self.hot = hot if hot is not None else {}
+        self.rest = rest if rest is not None else {}
+        self.version = version
+
+    def updated(self, changes):
+        hot = None
+        rest = None
+
+        for attr, value in changes.items():
+            if attr in HOT_ATTRS:
+                if hot is None:
+                    hot = self.hot.copy()
+                hot[attr] = value
+            else:
+                if rest is None:
+                    rest = self.rest.copy()
+                rest[attr] = value
+
+        return Attributes(hot if hot is not None else self.hot,
+                rest if rest is not None else self.rest, next(attr_versions))
+
+    # A new version with only attrs, sharing whatever half it can.
+
+    def only(self, attrs):
+        hot = self.hot
+        for attr in hot:
+            if attr not in attrs:
+                hot = dict([ (k, v) for (k, v) in self.hot.items() if k in attrs ])
+                break
+
+        rest = dict([ (k, v) for (k, v) in self.rest.items() if k in attrs ])
+
+        return Attributes(hot, rest, next(attr_versions))
+
+    def _half(self, attr):
+        if attr in HOT_ATTRS:
+            return self.hot
+        return self.rest
+
+    def __getitem__(self, attr):
+        return self._half(attr)[attr]
+
+    def __setitem__(self, attr, value):
+        self._half(attr)[attr] = value
+
+    def __delitem__(self, attr):
+        del self._half(attr)[attr]
+
+    def __contains__(self, attr):
+        return attr in self.hot or attr in self.rest
+
+    def get(self, attr, default=None):
+        return self._half(attr).get(attr, default)
+
+    def __iter__(self):
+        return itertools.chain(self.hot, self.rest)
+
+    def __len__(self):
+        return len(self.hot) + len(self.rest)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+# The most item ids we'll ask for in a single ATTRIBUTES message.
+
+ATTRIBUTES_BATCH = 256
+
+# Seconds before attributes that were requested, but never arrived, can be
+# requested again.
+
+ATTRIBUTES_TIMEOUT = 30
+
 alltagcores = []
 
+# A TagCore is the list of a tag's item ids, in the daemon's order. It also
+# maps each id to its position, so membership and index() are O(1), and it
+# can be diffed against a new list of ids in linear time.
+
 class TagCore(list):
     def __init__(self, tag):
         list.__init__(self)
         self.tag = tag
 
+        self.positions = {}
+
         self.changes = False
         self.was_reset = False
 
@@ -44,11 +160,53 @@ class TagCore(list):
 
         del self[:]
         self.extend(ids)
+
+        self.positions = {}
+        for i, id in enumerate(self):
+            if id not in self.positions:
+                self.positions[id] = i
+
         self.changed()
 
         self.lock.release_write()
 
+    def __contains__(self, id):
+        return id in self.positions
+
+    def index(self, id, *args):
+        if args or id not in self.positions:
+            return list.index(self, id, *args)
+        return self.positions[id]
+
+    # Compare with a new list of ids. Returns (added, removed, kept), the ids
+    # only in ids, only in self, and in both, in the order of the list
+    # they're taken from.
+
+    def diff(self, ids):
+        new = set(ids)
+
+        added = []
+        kept = []
+        for id in ids:
+            if id in self.positions:
+                kept.append(id)
+            else:
+                added.append(id)
+
+        removed = [ id for id in self if id not in new ]
+
+        return (added, removed, kept)
+
 class TagUpdater(SubThread):
+    def __init__(self):
+        # ATTRIBUTES requests are queued up and sent by flush_attributes,
+        # so a burst of them becomes one message (or a few) for each set of
+        # attributes. Pending requests, attrs -> { id : None } in order. These
+        # exist before init because the GUI starts flushing first.
+
+        self.pending_attrs = {}
+        self.autoattr_pending = False
+
     def init(self, backend):
         SubThread.init(self, backend)
 
@@ -57,6 +215,31 @@ class TagUpdater(SubThread):
         self.attributes = {}
         self.lock = RWLock("tagupdater")
 
+        # Who wants to know about changes to which ids, id -> [ callbacks ]
+        self.subscribers = {}
+
+        # Attributes in needed_attrs are kept as long as their story is, but
+        # anything else (i.e. content fetched for the reader) is only cached,
+        # up to reader.attribute_cache bytes. Ids with cached attributes, and
+        # their size, least recently used first.
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_size = config.get_opt("reader.attribute_cache")
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+        # The id last looked up, so a lookup is counted as one hit or miss, no
+        # matter how many times the reader is redrawn.
+        self.cache_lookup = None
+
+        # Attributes requested per id, and not answered yet, with the time of
+        # the first request, id -> (attrs, time).
+
+        self.requested_attrs = {}
+
+        self.search_index = SearchIndex(config.get_opt("taglist.search_attributes"))
+
         self.start_pthread()
 
         # Setup automatic attributes.
@@ -92,6 +275,7 @@ class TagUpdater(SubThread):
         on_hook("curses_del_tag", self.on_del_tag)
         on_hook("curses_stories_removed", self.on_stories_removed)
         on_hook("curses_def_opt_change", self.on_def_opt_change)
+        on_hook("curses_opt_change", self.on_opt_change)
 
         config_lock.release_read()
 
@@ -124,13 +308,27 @@ class TagUpdater(SubThread):
 
         self.lock.acquire_write()
         for item in items:
-            if tagcore and item.id in tc:
+            if tagcore and item.id in tagcore:
                 log.debug("%s still in tagcore, not removing", item.id)
                 continue
             if item.id in self.attributes:
                 del self.attributes[item.id]
+            if item.id in self.cache:
+                self.cache_bytes -= self.cache.pop(item.id)
+            if item.id in self.requested_attrs:
+                del self.requested_attrs[item.id]
+            self.search_index.remove(item.id)
         self.lock.release_write()
 
+    def on_opt_change(self, conf):
+        if "reader" in conf and "attribute_cache" in conf["reader"]:
+            self.lock.acquire_write()
+            self.cache_size = conf["reader"]["attribute_cache"]
+            evicted = self._evict()
+            self.lock.release_write()
+
+            self._notify(evicted)
+
     # Changes to global filters should force a full refresh.
 
     def on_def_opt_change(self, defaults):
@@ -143,19 +341,96 @@ class TagUpdater(SubThread):
         self.lock.acquire_write()
 
         for key in d.keys():
-            if key in self.attributes:
+            if key in self.requested_attrs:
+                del self.requested_attrs[key]
 
-                # If we're updating, we want to create a whole new dict object
-                # so that our stories dicts don't get updated without a sync
+            # Replace, rather than update, so that stories don't see changes
+            # until they sync.
 
-                cp = self.attributes[key].copy()
-                cp.update(d[key])
-                self.attributes[key] = cp
+            if key in self.attributes:
+                self.attributes[key] = self.attributes[key].updated(d[key])
             else:
-                self.attributes[key] = d[key]
+                self.attributes[key] = Attributes().updated(d[key])
+
+            self.search_index.update(key, self.attributes[key])
+
+            for attr in d[key]:
+                if attr not in self.needed_attrs:
+                    self._cache(key)
+                    break
+
+        # Make room for what we just got. Stories holding evicted attributes
+        # are notified like any other change, so they let go of them too.
+
+        evicted = self._evict()
+
         self.lock.release_write()
 
-        call_hook("curses_attributes", [ self.attributes ])
+        self._notify(list(d.keys()) + evicted)
+
+    # Only the subscribers to the changed ids are notified, so the cost of a
+    # message is in proportion to its size, not the number of items.
+
+    def _notify(self, ids):
+        if not ids:
+            return
+
+        changed = {}
+        notify = []
+
+        self.lock.acquire_read()
+        for key in ids:
+            if key not in self.attributes:
+                continue
+            changed[key] = self.attributes[key]
+            for callback in self.subscribers.get(key, []):
+                notify.append((callback, { key : changed[key] }))
+        self.lock.release_read()
+
+        for callback, attributes in notify:
+            callback(attributes)
+
+        # Anyone else (i.e. the reader waiting on content) still gets a hook,
+        # but only with what changed.
+
+        call_hook("curses_attributes", [ changed ])
+
+    # Call with lock held for writing.
+
+    def _cache(self, id):
+        if id in self.cache:
+            self.cache_bytes -= self.cache.pop(id)
+
+        size = 0
+        for attr, value in self.attributes[id].items():
+            if attr not in self.needed_attrs:
+                size += attr_size(value)
+
+        self.cache[id] = size
+        self.cache_bytes += size
+
+    # Drop the cached attributes of the least recently used ids until we're
+    # back under cache_size, returning the ids. The most recent is always
+    # kept, or something too big to fit would be fetched over and over.
+
+    def _evict(self):
+        evicted = []
+
+        while self.cache_bytes > self.cache_size and len(self.cache) > 1:
+            id, size = self.cache.popitem(False)
+            self.cache_bytes -= size
+            self.cache_evictions += 1
+
+            if id not in self.attributes:
+                continue
+
+            self.attributes[id] = self.attributes[id].only(self.needed_attrs)
+            evicted.append(id)
+
+        if evicted:
+            log.debug("Evicted cached attributes of %d items", len(evicted))
+
+        return evicted
 
     def prot_items(self, updates):
         # Daemon should now only return with one tag in an items response
@@ -168,34 +443,12 @@ class TagUpdater(SubThread):
         else:
             return
 
-        sorted_updated_ids = list(enumerate(updates[tag]))
-        sorted_updated_ids.sort(key=lambda x : x[1])
-
-        sorted_current_ids = list(enumerate(have_tag))
-        sorted_current_ids.sort(key=lambda x : x[1])
-
-        new_ids = []
-        cur_ids = []
-        old_ids = []
-
-        for c_place, c_id in sorted_current_ids:
-            while sorted_updated_ids and c_id > sorted_updated_ids[0][1]:
-                new_ids.append(sorted_updated_ids.pop(0))
+        new_ids, old_ids, cur_ids = have_tag.diff(updates[tag])
 
-            if not sorted_updated_ids or c_id < sorted_updated_ids[0][1]:
-                old_ids.append(c_id)
-            else:
-                cur_ids.append(sorted_updated_ids.pop(0))
-
-        new_ids += sorted_updated_ids
-
-        all_ids = new_ids + cur_ids
-        all_ids.sort()
-
-        have_tag.set_items([x[1] for x in all_ids])
+        have_tag.set_items(updates[tag])
 
         if new_ids:
-            call_hook("curses_items_added", [ have_tag, [x[1] for x in new_ids] ] )
+            call_hook("curses_items_added", [ have_tag, new_ids ] )
 
         if old_ids:
             call_hook("curses_items_removed", [ have_tag, old_ids ] )
@@ -229,11 +482,63 @@ class TagUpdater(SubThread):
         self.write("TRANSFORM", { name : transform })
         self.reset()
 
+    # Return the set of ids with search attributes matching rgx, which must
+    # contain all of literals, out of within if given (see search.py).
+
+    def search(self, rgx, literals, within=None):
+        self.lock.acquire_read()
+        matches = self.search_index.search(rgx, literals, within)
+        self.lock.release_read()
+        return matches
+
+    # The same, in two steps, so a long search can match a chunk of
+    # candidates at a time without holding our lock throughout.
+
+    def search_candidates(self, literals, within=None):
+        self.lock.acquire_read()
+        candidates = self.search_index.candidates(literals, within)
+        self.lock.release_read()
+        return candidates
+
+    def search_match(self, rgx, ids):
+        self.lock.acquire_read()
+        matches = self.search_index.match(rgx, ids)
+        self.lock.release_read()
+        return matches
+
+    def set_search_attributes(self, attrs):
+        self.lock.acquire_write()
+        self.search_index = SearchIndex(attrs)
+        for id in self.attributes:
+            self.search_index.update(id, self.attributes[id])
+        self.lock.release_write()
+
+    # Register callback to be called with { id : attributes } for any of ids
+    # whose attributes change.
+
+    def subscribe(self, ids, callback):
+        self.lock.acquire_write()
+        for id in ids:
+            if id in self.subscribers:
+                self.subscribers[id].append(callback)
+            else:
+                self.subscribers[id] = [ callback ]
+        self.lock.release_write()
+
+    def unsubscribe(self, ids, callback):
+        self.lock.acquire_write()
+        for id in ids:
+            if id in self.subscribers and callback in self.subscribers[id]:
+                self.subscribers[id].remove(callback)
+                if not self.subscribers[id]:
+                    del self.subscribers[id]
+        self.lock.release_write()
+
     # Writes are already serialized, so in the meantime, we protect
     # self.attributes and self.needed_attrs with our lock.
 
     def get_attributes(self, id):
-        r = {}
+        r = Attributes()
         self.lock.acquire_read()
         if id in self.attributes:
             r = self.attributes[id]
@@ -249,8 +554,111 @@ class TagUpdater(SubThread):
         self.write("SETATTRIBUTES", arg)
         self.lock.release_write()
 
+    # Queue a request for attrs of id, unless they've already been asked for.
+    # An empty attrs is a request for everything, and is always queued.
+
     def request_attributes(self, id, attrs):
-        self.write("ATTRIBUTES", { id : attrs })
+        self.lock.acquire_write()
+        self._request_attributes(id, attrs)
+        self.lock.release_write()
+
+    # Call with lock held for writing.
+
+    def _request_attributes(self, id, attrs):
+        now = time.time()
+
+        # In case the daemon dropped a request, don't wait for an answer
+        # forever.
+
+        if id in self.requested_attrs and\
+                now - self.requested_attrs[id][1] > ATTRIBUTES_TIMEOUT:
+            del self.requested_attrs[id]
+
+        if id not in self.requested_attrs:
+            self.requested_attrs[id] = (set(), now)
+        requested = self.requested_attrs[id][0]
+
+        missing = [ a for a in attrs if a not in requested ]
+        if attrs and not missing:
+            return
+
+        requested.update(missing)
+
+        key = tuple(sorted(missing))
+        if key not in self.pending_attrs:
+            self.pending_attrs[key] = {}
+        self.pending_attrs[key][id] = None
+
+    # Send everything queued since the last flush, called by the GUI on every
+    # pass and tick.
+
+    def flush_attributes(self):
+        if not self.pending_attrs and not self.autoattr_pending:
+            return
+
+        self.lock.acquire_write()
+
+        pending = self.pending_attrs
+        self.pending_attrs = {}
+
+        autoattr = None
+        if self.autoattr_pending:
+            autoattr = self.needed_attrs[:]
+            self.autoattr_pending = False
+
+        self.lock.release_write()
+
+        if autoattr:
+            self.write("AUTOATTR", autoattr)
+
+        for attrs, ids in pending.items():
+            ids = list(ids.keys())
+            attrs = list(attrs)
+
+            log.debug("Requesting %s for %d items", attrs, len(ids))
+
+            for i in range(0, len(ids), ATTRIBUTES_BATCH):
+                self.write("ATTRIBUTES", dict([ (id, attrs)\
+                        for id in ids[i:i + ATTRIBUTES_BATCH] ]))
+
+    # For users of cached attributes, like the reader. If the story has
+    # everything it needs, call touch_attributes so the id counts as recently
+    # used. Otherwise, fetch_attributes gets whatever has been evicted (or
+    # never fetched) from the daemon again, to be announced like any other
+    # attributes. Calls for the same id in a row are the same lookup.
+
+    def touch_attributes(self, id):
+        self.lock.acquire_write()
+        if id != self.cache_lookup:
+            self.cache_lookup = id
+            self.cache_hits += 1
+        if id in self.cache:
+            self.cache.move_to_end(id)
+        self.lock.release_write()
+
+    def fetch_attributes(self, id, attrs):
+        self.lock.acquire_write()
+
+        # A new lookup asks again, even if an earlier request is outstanding.
+
+        if id != self.cache_lookup:
+            self.cache_lookup = id
+            self.cache_misses += 1
+            if id in self.requested_attrs:
+                del self.requested_attrs[id]
+
+        self._request_attributes(id, attrs)
+
+        self.lock.release_write()
+
+    # (hits, misses, evictions, ids cached, bytes cached, cache size)
+
+    def cache_stats(self):
+        self.lock.acquire_read()
+        r = (self.cache_hits, self.cache_misses, self.cache_evictions,
+                len(self.cache), self.cache_bytes, self.cache_size)
+        self.lock.release_read()
+        return r
 
     def need_attributes(self, id, attrs):
         self.lock.acquire_write()
@@ -265,13 +673,13 @@ class TagUpdater(SubThread):
 
         if updated:
             self.needed_attrs = needed
-            self.write("AUTOATTR", self.needed_attrs)
-
-        self.lock.release_write()
+            self.autoattr_pending = True
 
         # Even if we didn't update this time, make sure we attempt to get this
         # id's new needed attributes.
 
-        self.write("ATTRIBUTES", { id : needed })
+        self._request_attributes(id, needed)
+
+        self.lock.release_write()
 
 tag_updater = TagUpdater()
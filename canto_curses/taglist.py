@@ -11,11 +11,17 @@ from canto_next.plugins import Plugin
 
 from .command import register_commands, register_arg_types, unregister_all, _int_range, _int_check, _string
 from .tagcore import tag_updater, alltagcores
-from .locks import config_lock
+from .locks import config_lock, sync_lock
+from .search import regex_literals
 from .guibase import GuiBase
 from .reader import Reader
-from .tag import Tag, alltags
+from .theme import layout_stats
+from .tag import Tag, alltags, unread_total
 
+from collections import OrderedDict
+from threading import Thread
+from bisect import bisect_left, bisect_right
+import traceback
 import logging
 import curses
 import shlex
@@ -32,6 +38,69 @@ log = logging.getLogger("TAGLIST")
 class TagListPlugin(Plugin):
     pass
 
+# Background searches match this many candidates at a time, dropping locks in
+# between so the GUI stays responsive and the search can be cancelled.
+
+SEARCH_CHUNK = 1000
+
+# A Fenwick tree over the line counts of a list of objects, so that both the
+# line an object starts on, and the object on a given line, can be found in
+# O(log n) and kept up to date as objects are laid out.
+
+class LineIndex(object):
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.tree = [ 0 ] + self.counts
+
+        for i in range(1, len(self.tree)):
+            j = i + (i & -i)
+            if j < len(self.tree):
+                self.tree[j] += self.tree[i]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, i):
+        return self.counts[i]
+
+    def __setitem__(self, i, count):
+        delta = count - self.counts[i]
+        self.counts[i] = count
+
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    # The line the i'th object starts on (the sum of the counts before it).
+
+    def line(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.line(len(self.counts))
+
+    # The last object starting on or before the given line.
+
+    def find(self, line):
+        if not self.counts:
+            return None
+
+        i = 0
+        step = 1 << (len(self.counts).bit_length() - 1)
+
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] <= line:
+                i += step
+                line -= self.tree[i]
+            step >>= 1
+
+        return min(i, len(self.counts) - 1)
+
 class TagList(GuiBase):
     def init(self, pad, callbacks):
         GuiBase.init(self)
@@ -51,8 +120,65 @@ class TagList(GuiBase):
         self.first_story = None
         self.last_story = None
 
+        # The linked list of objects, as one span per visible tag (the tag,
+        # followed by its stories unless it's collapsed), along with the
+        # collapsed state and height they were linked with, and the names of
+        # tags whose stories have changed since.
+        self.spans = []
+        self.span_collapsed = []
+        self.linked_height = None
+        self.linked_width = None
+        self.relink_tags = []
+
+        # Line counts for each span, and the total for each span, so we can
+        # find an object's line without walking the list. Counts are only
+        # known for objects that have been laid out at the current width,
+        # anything else counts as a single line until it is.
+        self.span_lines = []
+        self.tag_lines = LineIndex([])
+
+        # The sel_offset of each visible tag.
+        self.sel_offsets = []
+
+        # Objects holding curses pads, least recently drawn first, keyed by
+        # id() because Tags and Storys aren't hashable. Past pad_pool_size,
+        # the oldest are told to release their pads, and will replay their
+        # cached layout onto a new one if they're drawn again.
+        self.pad_pool = OrderedDict()
+        self.pad_pool_size = 0
+
+        # Idle prelayout, working outward from the last redraw, with the
+        # number of lines left to lay out on either side.
+        self.prelayout_above = None
+        self.prelayout_above_lines = 0
+        self.prelayout_below = None
+        self.prelayout_below_lines = 0
+
+        # Bumping search_gen cancels any background search. While searching
+        # as you type, the visible stories by id, and the matches for each
+        # term typed so far, so each keystroke only narrows a previous result.
+        self.search_gen = 0
+        self.searching = False
+        self.isearch_stories = None
+        self.isearch_results = None
+        self.isearch_marked = None
+
+        # Marked stories by id(), and the linked ones as sorted lists of their
+        # positions, (span, position) as given by _locate, and the stories
+        # themselves. The sorted lists are dropped when a span is re-indexed,
+        # and rebuilt on the next jump.
+        self.marked = {}
+        self.marked_order = None
+        self.marked_objs = None
+
         self.tags = []
 
+        # Every story in self.tags, in order, and each one's index in it by
+        # id(), for item-list arguments. Rebuilt only after the stories or
+        # tags change, rather than for every command.
+        self.all_items = None
+        self.all_items_idx = None
+
         # Hold config log so we don't miss any new TagCores or get updates
         # before we're ready.
 
@@ -63,6 +189,8 @@ class TagList(GuiBase):
         on_hook("curses_stories_added", self.on_stories_added, self)
         on_hook("curses_stories_removed", self.on_stories_removed, self)
         on_hook("curses_opt_change", self.on_opt_change, self)
+        on_hook("curses_keypress", self.on_keypress, self)
+        on_hook("curses_story_marked", self.on_story_marked, self)
         on_hook("curses_new_tagcore", self.on_new_tagcore, self)
         on_hook("curses_del_tagcore", self.on_del_tagcore, self)
 
@@ -78,6 +206,7 @@ class TagList(GuiBase):
 
         base_cmds = {
             "remote delfeed" : (self.cmd_delfeed, ["tag-list"], "Unsubscribe from feeds."),
+            "stats" : (self.cmd_stats, [], "Show rendering cache statistics."),
         }
 
         nav_cmds = {
@@ -151,6 +280,7 @@ class TagList(GuiBase):
 
     def die(self):
         log.debug("Cleaning up hooks...")
+        self.search_gen += 1
         unhook_all(self)
         unregister_all(self)
 
@@ -183,35 +313,41 @@ class TagList(GuiBase):
             self.callbacks["release_gui"]()
             on_hook("curses_var_change", self.unhook_item_list, self)
 
+    def _all_items(self):
+        if self.all_items is None:
+            self.all_items = []
+            for tag in self.tags:
+                self.all_items.extend(tag)
+
+            self.all_items_idx = {}
+            for i, item in enumerate(self.all_items):
+                self.all_items_idx[id(item)] = i
+
+        return self.all_items
+
     def type_item_list(self):
-        all_items = []
-        for tag in self.tags:
-            for s in tag:
-                all_items.append(s)
+        all_items = self._all_items()
 
         domains = { 'all' : all_items }
 
         syms = { 'all' : {} }
         sel = self.callbacks["get_var"]("selected")
+        sel_idx = None
         if sel and not sel.is_tag:
+            sel_idx = self.all_items_idx.get(id(sel))
 
-            # If we have a selection, we have a sensible tag domain
+        if sel_idx is not None:
+
+            # If we have a selection, we have a sensible tag domain, which
+            # starts where its first story is in all_items.
 
             tag = self.tag_by_item(sel)
-            domains['tag']  = [ x for x in self.tag_by_item(sel) ]
+            domains['tag'] = tag
             syms['tag'] = {}
+            syms['tag']['.'] = [ sel_idx - self.all_items_idx[id(tag[0])] ]
+            syms['tag']['*'] = range(0, len(tag))
 
-            if not sel.is_tag:
-                syms['tag']['.'] = [ domains['tag'].index(sel) ]
-                syms['tag']['*'] = range(0, len(domains['tag']))
-            elif len(sel) > 0:
-                syms['tag']['.'] = [ 0 ]
-                syms['tag']['*'] = range(0, len(sel))
-            else:
-                syms['tag']['.'] = []
-                syms['tag']['*'] = []
-
-            syms['all']['.'] = [ all_items.index(sel) ]
+            syms['all']['.'] = [ sel_idx ]
         else:
             syms['all']['.'] = [ ]
 
@@ -226,7 +362,13 @@ class TagList(GuiBase):
             elif self.first_sel and not self.first_sel.is_tag:
                 fallback = [ self.first_sel ]
 
-        return (None, lambda x: _int_range("item", domains, syms, fallback, x))
+        # Items may still be placeholders, they materialize as commands use
+        # their content, so "item-state read *" doesn't set up every story.
+
+        def item_list(x):
+            return _int_range("item", domains, syms, fallback, x, lambda s : s.id)
+
+        return (None, item_list)
 
     def unhook_tag_list(self, vars):
         # Perhaps this should be a separate hook for command completion?
@@ -265,7 +407,7 @@ class TagList(GuiBase):
             if tag.tag.startswith("maintag:"):
                 syms['all'][tag.tag[8:]] = [ i ]
 
-        return (None, lambda x: _int_range("tag", domains, syms, deftags, x))
+        return (None, lambda x: _int_range("tag", domains, syms, deftags, x, lambda t : t.tag))
 
     # This will accept any state, but should offer some completions for sensible ones
 
@@ -281,6 +423,8 @@ class TagList(GuiBase):
         log.debug("taglist on_del_tag")
         for tagobj in alltags:
             if tagobj.tag == tagcore.tag:
+                self._unpool([ tagobj ] + tagobj[:])
+                self._drop_marked(tagobj)
                 tagobj.die()
 
         self.callbacks["set_var"]("needs_refresh", True)
@@ -306,14 +450,36 @@ class TagList(GuiBase):
 
     def on_stories_added(self, tag, items):
         # Items being added implies we need to remap them
+        self._need_relink(tag)
+        self.all_items = None
         self.callbacks["set_var"]("needs_refresh", True)
 
     # Called with sync_lock, so we are unrestricted.
 
     def on_stories_removed(self, tag, items):
         # Items being removed implies we need to remap them.
+        self._need_relink(tag)
+        self.all_items = None
+        self._unpool(items)
+        self._drop_marked(items)
         self.callbacks["set_var"]("needs_refresh", True)
 
+    def cmd_stats(self):
+        log.info("Pads: %d objects (pool size %d)", len(self.pad_pool), self.pad_pool_size)
+        log.info("Marked: %d items", len(self.marked))
+        log.info("Unread: %d items", unread_total())
+
+        hits, misses, evictions, entries, size, limit = tag_updater.cache_stats()
+        log.info("Attribute cache: %d hits, %d misses, %d evictions", hits, misses, evictions)
+        log.info("Attribute cache: %d items, %d / %d bytes", entries, size, limit)
+
+        layouts, ops, max_ops = layout_stats()
+        log.info("Layouts: %d cached, %d / %d ops", layouts, ops, max_ops)
+
+    def _need_relink(self, tag):
+        if tag.tag not in self.relink_tags:
+            self.relink_tags.append(tag.tag)
+
     def on_opt_change(self, conf):
         if "taglist" not in conf or "search_attributes" not in conf["taglist"]:
             return
@@ -323,6 +489,8 @@ class TagList(GuiBase):
         need_attrs = {}
         sa = self.callbacks["get_opt"]("taglist.search_attributes")
 
+        tag_updater.set_search_attributes(sa)
+
         # Make sure that we have all attributes needed for a search.
         for tag in alltagcores:
             for item in tag:
@@ -337,7 +505,7 @@ class TagList(GuiBase):
         for tag in tags:
             for item in tag:
                 if item.handle_state(state):
-                    attributes[item.id] = { "canto-state" : item.content["canto-state"] }
+                    attributes[item.id] = { "canto-state" : item.state_content()["canto-state"] }
 
         if attributes:
             tag_updater.set_attributes(attributes)
@@ -348,7 +516,7 @@ class TagList(GuiBase):
         attributes = {}
         for item in items:
             if item.handle_state(state):
-                attributes[item.id] = { "canto-state" : item.content["canto-state"] }
+                attributes[item.id] = { "canto-state" : item.state_content()["canto-state"] }
 
         if attributes:
             tag_updater.set_attributes(attributes)
@@ -365,7 +533,7 @@ class TagList(GuiBase):
         attributes = {}
         for item in items:
             if item.handle_tag(tag):
-                attributes[item.id] = { "canto-tags" : item.content["canto-tags"] }
+                attributes[item.id] = { "canto-tags" : item.state_content()["canto-tags"] }
 
         if attributes:
             tag_updater.set_attributes(attributes)
@@ -399,7 +567,7 @@ class TagList(GuiBase):
         # start and next sel.
 
         while o and o != ns:
-            lines += o.lines(self.width)
+            lines += self._lines(o)
             o = o.next_obj
 
         return (ns, lines)
@@ -420,13 +588,19 @@ class TagList(GuiBase):
 
         while o and o != ps:
             o = o.prev_obj
-            lines += o.lines(self.width)
+            lines += self._lines(o)
 
         return (ps, lines)
 
     def cmd_rel_set_cursor(self, relidx):
         sel = self.callbacks["get_var"]("selected")
-        if sel:
+
+        # Jump straight to the target, using the index to find how far it is.
+        if sel and self._locate(sel):
+            target = self._sel_at(sel.sel_offset + relidx)
+            curpos = sel.curpos + self._distance(sel, target)
+            self._set_cursor(target, curpos)
+        elif sel:
             target_idx = sel.sel_offset + relidx
             curpos = sel.curpos
 
@@ -476,12 +650,12 @@ class TagList(GuiBase):
 
             tag = self.tag_by_obj(item)
 
-            wl_top = max(curstyle["edge"], tag.lines(self.width))
+            wl_top = max(curstyle["edge"], self._lines(tag))
 
             # Similarly, if the current item is larger than the (edge + 1), the
             # scroll won't be triggered, so we take the max edge there too.
 
-            wl_bottom = (self.height - 1) - max(curstyle["edge"], item.lines(self.width))
+            wl_bottom = (self.height - 1) - max(curstyle["edge"], self._lines(item))
 
             if window_location > wl_bottom:
                 if curstyle["scroll"] == "scroll":
@@ -534,14 +708,14 @@ class TagList(GuiBase):
             while scroll > 0 and sel.prev_sel:
                 pstory = sel.prev_sel
                 while sel != pstory:
-                    scroll -= sel.lines(self.width)
+                    scroll -= self._lines(sel)
                     sel = sel.prev_obj
 
             self._set_cursor(sel, target_offset)
         else:
             while scroll > 0 and target_obj.prev_obj:
                 target_obj = target_obj.prev_obj
-                scroll -= target_obj.lines(self.width)
+                scroll -= self._lines(target_obj)
 
             self.callbacks["set_var"]("target_obj", target_obj)
             self.callbacks["set_var"]("target_offset", target_offset)
@@ -560,18 +734,18 @@ class TagList(GuiBase):
 
         if sel:
             while scroll > 0 and sel.next_sel:
-                if scroll < sel.lines(self.width):
+                if scroll < self._lines(sel):
                     break
 
                 nstory = sel.next_sel
                 while sel != nstory:
-                    scroll -= sel.lines(self.width)
+                    scroll -= self._lines(sel)
                     sel = sel.next_obj
 
             self._set_cursor(sel, target_offset)
         else:
             while scroll > 0 and target_obj.next_obj:
-                scroll -= target_obj.lines(self.width)
+                scroll -= self._lines(target_obj)
                 if scroll < 0:
                     break
                 target_obj = target_obj.next_obj
@@ -687,7 +861,7 @@ class TagList(GuiBase):
 
         s = self.callbacks["get_var"]("selected")
         if s and tag == s and len(tag) != 0:
-            toffset = self.callbacks["get_var"]("target_offset") + tag.lines(self.width)
+            toffset = self.callbacks["get_var"]("target_offset") + self._lines(tag)
             self._set_cursor(tag[0], toffset)
 
         self.callbacks["set_tag_opt"](tag.tag, "collapsed", False)
@@ -703,116 +877,298 @@ class TagList(GuiBase):
             else:
                 self._collapse_tag(tag)
 
-    def search(self, regex):
+    # Mark the stories whose search attributes match regex, unmark the rest.
+    # The matching is done against tag_updater's index, which uses literals
+    # (strings any match must contain) to avoid running the regex against
+    # every item.
+
+    # This happens in a background thread, so on huge lists the GUI keeps
+    # going, shows progress, and any keypress cancels the search. Unless more
+    # commands follow (i.e. "search foo & next-marked"), which need the marks
+    # in place when they run, so then it's done right away.
+
+    def search(self, regex, literals):
         try:
             rgx = re.compile(regex)
         except Exception as e:
             self.callbacks["set_var"]("error_msg", e)
             return
 
+        self.search_gen += 1
+
+        if self.callbacks["get_var"]("commands_pending"):
+            self.searching = False
+            self._mark_matches(tag_updater.search(rgx, literals))
+            self.callbacks["set_var"]("input_status", "%d marked" % len(self.marked))
+            return
+
+        self.searching = True
+        self.callbacks["set_var"]("input_status", "Searching...")
+
+        t = Thread(target = self._search_thread, args = (self.search_gen, rgx, literals))
+        t.daemon = True
+        t.start()
+
+    # Any key cancels a search, leaving the marks as they were, and clears the
+    # status it, or a jump to a marked item, left.
+
+    def on_keypress(self, key):
+        if not self.searching and not self.callbacks["get_var"]("input_status"):
+            return
+
+        sync_lock.acquire_write()
+        searching = self.searching
+        self._end_search()
+        if searching:
+            self.callbacks["set_var"]("input_status", "Search cancelled")
+        sync_lock.release_write()
+
+    # Call with sync_lock.
+
+    def _end_search(self):
+        self.search_gen += 1
+        self.searching = False
+        self.callbacks["set_var"]("input_status", "")
+
+    def _search_thread(self, gen, rgx, literals):
+        try:
+            self._search(gen, rgx, literals)
+        except Exception as e:
+            log.error("Exception in search: %s" % e)
+            log.error(traceback.format_exc())
+
+    def _search(self, gen, rgx, literals):
+        candidates = tag_updater.search_candidates(literals)
+        matches = set()
+
+        for i in range(0, len(candidates), SEARCH_CHUNK):
+            if gen != self.search_gen:
+                return
+
+            matches |= tag_updater.search_match(rgx, candidates[i:i + SEARCH_CHUNK])
+
+            sync_lock.acquire_write()
+            if gen == self.search_gen:
+                self.callbacks["set_var"]("input_status", "Searching... %d%%" %\
+                        (100 * min(i + SEARCH_CHUNK, len(candidates)) // len(candidates)))
+            sync_lock.release_write()
+            self.callbacks["release_gui"]()
+
+        # The marks are all changed at once, so a cancelled search never
+        # leaves some stories marked by it and the rest by the last one.
+
+        sync_lock.acquire_write()
+        try:
+            if gen != self.search_gen:
+                return
+
+            self._mark_matches(matches)
+            self._end_search()
+            self.callbacks["set_var"]("input_status", "%d marked" % len(self.marked))
+        finally:
+            sync_lock.release_write()
+
+        self.callbacks["release_gui"]()
+
+    # Mark the visible stories in matches, unmark the rest. Call with
+    # sync_lock.
+
+    def _mark_matches(self, matches):
         story = self.first_story
-        terms = self.callbacks["get_opt"]("taglist.search_attributes")
+        while story is not None:
+            if story.id in matches:
+                story.mark()
+            else:
+                story.unmark()
+            story = story.next_story
 
-        while story:
-            for t in terms:
+    # Search as you type. Called with the line so far, in the input thread
+    # which already holds sync_lock, so this is done immediately.
 
-                # Shouldn't happen unless a search happens before
-                # the daemon can respond to the ATTRIBUTES request.
+    def on_isearch_change(self, term):
+        if term not in self.isearch_results:
 
-                if t not in story.content:
-                    continue
+            # Any match for term must also match every prefix of it.
 
-                if rgx.match(story.content[t]):
-                    story.mark()
-                    break
+            prefix = term[:-1]
+            while prefix not in self.isearch_results:
+                prefix = prefix[:-1]
+
+            if prefix:
+                within = self.isearch_results[prefix]
             else:
+                within = None
+
+            rgx = re.compile(".*" + re.escape(term) + ".*")
+            self.isearch_results[term] = tag_updater.search(rgx, [ term ], within)
+
+        self._isearch_mark(self.isearch_results[term])
+
+    # Mark the stories in ids, and unmark the rest, only touching those that
+    # have changed since the last keystroke.
+
+    def _isearch_mark(self, ids):
+        ids = set([ id for id in ids if id in self.isearch_stories ])
+
+        for id in self.isearch_marked - ids:
+            for story in self.isearch_stories[id]:
                 story.unmark()
 
+        for id in ids - self.isearch_marked:
+            for story in self.isearch_stories[id]:
+                story.mark()
+
+        self.isearch_marked = ids
+
+    def isearch(self, prompt):
+        self.isearch_stories = {}
+        story = self.first_story
+        while story is not None:
+            if story.id in self.isearch_stories:
+                self.isearch_stories[story.id].append(story)
+            else:
+                self.isearch_stories[story.id] = [ story ]
             story = story.next_story
 
+        # Stories are only marked while typing if they match, so remember the
+        # previous marks in case the search is abandoned.
+
+        marked = set([ id for id in self.isearch_stories\
+                if self.isearch_stories[id][0].marked ])
+
+        self.isearch_marked = marked
+        self.isearch_results = { "" : set() }
+
+        term = self.callbacks["input"](prompt, False, self.on_isearch_change)
+
+        if term:
+            self.on_isearch_change(term)
+        else:
+            self._isearch_mark(marked)
+
+        self.isearch_stories = None
+        self.isearch_results = None
+        self.isearch_marked = None
+
         self.callbacks["set_var"]("needs_redraw", True)
 
     def cmd_search(self, term):
         if not term:
+            if self.callbacks["get_opt"]("taglist.search_as_you_type"):
+                return self.isearch("search:")
+
             term = self.callbacks["input"]("search:", False)
         if not term:
             return
 
         rgx = ".*" + re.escape(term) + ".*"
-        return self.search(rgx)
+        return self.search(rgx, [ term ])
 
     def cmd_search_regex(self, term):
         if not term:
             term = self.callbacks["input"]("search-regex:", False)
         if not term:
             return
-        return self.search(term)
+        return self.search(term, regex_literals(term))
 
-    def cmd_next_marked(self):
-        start = self.callbacks["get_var"]("selected")
+    # Keep track of marked stories, so next-marked / prev-marked don't have
+    # to walk the list to find them.
 
-        # This works for tags and stories alike.
-        if start:
-            cur = start.next_story
-        else:
-            start = self.first_story
-            cur = start
+    def on_story_marked(self, story, marked):
+        if marked:
+            self.marked[id(story)] = story
+        elif self.marked.pop(id(story), None) is None:
+            return
+
+        if self.marked_order is None:
+            return
 
-        # There's nothing to search
-        if not cur:
+        loc = self._locate(story)
+        if not loc:
             return
 
-        curpos = cur.curpos
+        if marked:
+            i = bisect_left(self.marked_order, loc)
+            self.marked_order.insert(i, loc)
+            self.marked_objs.insert(i, story)
+        else:
+            i = bisect_left(self.marked_order, loc)
+            if i < len(self.marked_order) and self.marked_objs[i] is story:
+                del self.marked_order[i]
+                del self.marked_objs[i]
 
-        while not cur or not cur.marked:
-            # Wrap to top
-            if cur == None:
-                cur = self.first_story
-                curpos = self.first_story.curpos
-            else:
-                cur, lines = self._iterate_forward(cur)
-                curpos += lines
-
-            # Make sure we don't infinite loop.
-            if cur == start:
-                if not cur.marked:
-                    self.callbacks["set_var"]\
-                            ("info_msg", "No marked items.")
-                break
+    def _drop_marked(self, items):
+        for item in items:
+            self.marked.pop(id(item), None)
+        self.marked_order = None
 
-        self._set_cursor(cur, curpos)
+    def _marked_index(self):
+        if self.marked_order is None:
+            located = []
+            for story in self.marked.values():
+                loc = self._locate(story)
+                if loc:
+                    located.append((loc, story))
+            located.sort(key=lambda x: x[0])
 
-    def cmd_prev_marked(self):
-        start = self.callbacks["get_var"]("selected")
+            self.marked_order = [ loc for (loc, story) in located ]
+            self.marked_objs = [ story for (loc, story) in located ]
 
-        # This works for tags and stories alike.
-        if start:
-            cur = start.prev_story
+        return (self.marked_order, self.marked_objs)
+
+    # Move to the marked story after (or before) the selection, wrapping
+    # around, and show where it is among the marked stories.
+
+    def _jump_marked(self, forward):
+        order, objs = self._marked_index()
+
+        if not order:
+            self.callbacks["set_var"]("info_msg", "No marked items.")
+            return
+
+        sel = self.callbacks["get_var"]("selected")
+        if sel is not None and self._locate(sel):
+            start = sel
+        elif forward:
+            start = self.first_sel
         else:
             start = self.last_story
-            cur = start
 
-        # There's nothing to search
-        if not cur:
+        if start is None:
             return
 
-        curpos = cur.curpos
+        loc = self._locate(start)
 
-        while not cur or not cur.marked:
-            # Wrap to bottom
-            if cur == None:
-                cur = self.last_story
-                curpos = self.last_story.curpos
-            else:
-                cur, lines = self._iterate_backward(cur)
-                curpos -= lines
+        # The first / last story may be gone since the last refresh, then
+        # just go to the first / last marked.
 
-            # Make sure we don't infinite loop.
-            if cur == start:
-                self.callbacks["set_var"]("info_msg", "No marked items.")
-                break
+        if loc is None:
+            i = 0 if forward else len(order) - 1
+        elif forward:
+            i = bisect_right(order, loc)
+            if start is not sel and i > 0 and order[i - 1] == loc:
+                i -= 1
+            if i == len(order):
+                i = 0
+        else:
+            i = bisect_left(order, loc) - 1
+            if start is not sel and i + 1 < len(order) and order[i + 1] == loc:
+                i += 1
+            if i < 0:
+                i = len(order) - 1
+
+        target = objs[i]
 
-        self._set_cursor(cur, curpos)
+        curpos = start.curpos + self._distance(start, target)
+        self._set_cursor(target, curpos)
+
+        self.callbacks["set_var"]("input_status", "Marked %d / %d" % (i + 1, len(order)))
+
+    def cmd_next_marked(self):
+        self._jump_marked(True)
+
+    def cmd_prev_marked(self):
+        self._jump_marked(False)
 
     def type_user_tag(self):
         utags = []
@@ -897,6 +1253,7 @@ class TagList(GuiBase):
 
     def update_tag_lists(self):
         curtags = self.callbacks["get_var"]("curtags")
+        prevtags = self.tags
         self.tags = []
 
         # Make sure to honor the order of tags in curtags.
@@ -906,6 +1263,9 @@ class TagList(GuiBase):
                 if tagobj.tag == tag:
                     self.tags.append(tagobj)
 
+        if [ id(t) for t in self.tags ] != [ id(t) for t in prevtags ]:
+            self.all_items = None
+
         # If selected is stale (i.e. its tag was deleted, the item should stick
         # around in all other cases) then unset it.
 
@@ -967,86 +1327,312 @@ class TagList(GuiBase):
     # Refresh updates information used to render the objects.
     # Effectively, we build a doubly linked list out of all
     # of the objects by setting obj.prev_obj and obj.next_obj.
+    #
+    # The list is only rebuilt from scratch when the visible tags change.
+    # Otherwise, only the spans of tags that have been synced or (un)collapsed
+    # since the last refresh are relinked.
 
     def refresh(self):
 
         log.debug("Taglist REFRESH!\n")
 
+        # Until the redraw that follows, there's nothing sensible to prelayout.
+
+        self.prelayout_above = None
+        self.prelayout_below = None
+
         self.update_tag_lists()
         self.update_target_obj()
 
+        vistags = self.callbacks["get_var"]("taglist_visible_tags")
+        collapsed = [ self.callbacks["get_tag_opt"](tag.tag, "collapsed")\
+                for tag in vistags ]
+
+        if self.height != self.linked_height or\
+                self.width != self.linked_width or\
+                len(vistags) != len(self.spans) or\
+                [ t for (t, s) in zip(vistags, self.spans) if t is not s[0] ]:
+
+            self.spans = [ self._span(t, c) for (t, c) in zip(vistags, collapsed) ]
+            self.span_collapsed = collapsed
+            self.linked_height = self.height
+            self.linked_width = self.width
+
+            self.span_lines = [ self._index_span(i) for i in range(len(self.spans)) ]
+            self.tag_lines = LineIndex([ l.total() for l in self.span_lines ])
+
+            if self.spans:
+                self._relink(0, len(self.spans))
+        else:
+            dirty = []
+            for i, tag in enumerate(vistags):
+                if tag.tag in self.relink_tags or collapsed[i] != self.span_collapsed[i]:
+                    self.spans[i] = self._span(tag, collapsed[i])
+                    self.span_collapsed[i] = collapsed[i]
+                    dirty.append(i)
+
+            for i in dirty:
+                self.span_lines[i] = self._index_span(i)
+                self.tag_lines[i] = self.span_lines[i].total()
+                self._relink(i, i + 1)
+
+        self.relink_tags = []
+        self.sel_offsets = [ tag.sel_offset for tag in vistags ]
+
         self.first_story = None
+        for obj, sel in self._span_objs(0, len(self.spans)):
+            if not obj.is_tag:
+                self.first_story = obj
+                break
+
+        # Keep track of last story.
+        for obj, sel in self._span_objs(0, len(self.spans), True):
+            if not obj.is_tag:
+                self.last_story = obj
+                break
+
+        self.callbacks["set_var"]("needs_redraw", True)
+
+    def _span(self, tag, collapsed):
+        # Collapsed tags (with items) skip stories.
+        if collapsed:
+            return [ tag ]
+        return [ tag ] + tag[:]
+
+    def _index_span(self, i):
+        self.marked_order = None
+
+        counts = []
+        for pos, obj in enumerate(self.spans[i]):
+            obj.span_pos = pos
+            if obj.width == self.width and not obj.changed:
+                counts.append(obj.lines(self.width))
+            else:
+                counts.append(1)
+        return LineIndex(counts)
+
+    # Return (span, position) of a linked object, or None.
+
+    def _locate(self, obj):
+        i = self.tag_by_obj(obj).visible_tag_offset
+        pos = getattr(obj, "span_pos", None)
+
+        if 0 <= i < len(self.spans) and pos != None and pos < len(self.spans[i])\
+                and self.spans[i][pos] is obj:
+            return (i, pos)
+        return None
+
+    # Get lines from an object, keeping the index up to date.
+
+    def _lines(self, obj):
+        lines = obj.lines(self.width)
+        self._set_lines(obj, lines)
+        return lines
+
+    # Returns True if the index changed.
+
+    def _set_lines(self, obj, lines):
+        loc = self._locate(obj)
+        if not loc:
+            return False
+
+        i, pos = loc
+        if self.span_lines[i][pos] == lines:
+            return False
+
+        self.span_lines[i][pos] = lines
+        self.tag_lines[i] = self.span_lines[i].total()
+        return True
+
+    def _line_of(self, obj):
+        i, pos = self._locate(obj)
+        return self.tag_lines.line(i) + self.span_lines[i].line(pos)
+
+    def _obj_at(self, line):
+        i = self.tag_lines.find(line)
+        line -= self.tag_lines.line(i)
+        return self.spans[i][self.span_lines[i].find(line)]
+
+    # Lines from the top of a to the top of b (negative if b is above a), by
+    # the index, or 0 if either isn't linked. Objects on or near the screen
+    # have been laid out by redraw and prelayout, and past those the exact
+    # count doesn't matter, the cursor is going to end up at the edge.
+
+    def _distance(self, a, b):
+        if self._locate(a) is None or self._locate(b) is None:
+            return 0
+        return self._line_of(b) - self._line_of(a)
 
+    # The selectable object with the given sel_offset, clamped to the first
+    # and last.
+
+    def _sel_at(self, idx):
+        if not self.spans:
+            return None
+
+        def sels(i):
+            if self.span_collapsed[i]:
+                return 1
+            return len(self.spans[i]) - 1
+
+        last = self.sel_offsets[-1] + sels(len(self.spans) - 1) - 1
+        if last < 0:
+            return None
+
+        idx = min(max(idx, 0), last)
+
+        i = bisect_right(self.sel_offsets, idx) - 1
+        while not sels(i):
+            i -= 1
+
+        if self.span_collapsed[i]:
+            return self.spans[i][0]
+        return self.spans[i][1 + idx - self.sel_offsets[i]]
+
+    # Yield (obj, selectable) for the objects in spans[lo:hi], optionally in
+    # reverse. Stories and collapsed tags are selectable.
+
+    def _span_objs(self, lo, hi, reverse = False):
+        if reverse:
+            idxs = range(hi - 1, lo - 1, -1)
+        else:
+            idxs = range(lo, hi)
+
+        for i in idxs:
+            span = self.spans[i]
+            if reverse:
+                span = reversed(span)
+            for obj in span:
+                yield (obj, not obj.is_tag or self.span_collapsed[i])
+
+    # Link the objects in spans[lo:hi], then fix up the objects outside of
+    # the range whose prev/next story/sel pointers cross into it. Those
+    # stretch, at most, to the nearest story and selectable object on either
+    # side, so the cost is the size of the range plus any run of empty tags
+    # around it.
+
+    def _relink(self, lo, hi):
         prev_obj = None
-        prev_story = None
-        prev_sel = None
+        if lo > 0:
+            prev_obj = self.spans[lo - 1][-1]
 
-        for tag in self.callbacks["get_var"]("taglist_visible_tags"):
-            tag.curpos = self.height
+        next_obj = None
+        if hi < len(self.spans):
+            next_obj = self.spans[hi][0]
 
-            tag.prev_obj = prev_obj
-            tag.next_obj = None
+        prev_story = None
+        prev_sel = None
 
-            tag.prev_story = prev_story
-            tag.next_story = None
+        for obj, sel in self._span_objs(0, lo, True):
+            if prev_story is None and not obj.is_tag:
+                prev_story = obj
+            if prev_sel is None and sel:
+                prev_sel = obj
+            if prev_story is not None and prev_sel is not None:
+                break
 
-            tag.prev_sel = prev_sel
-            tag.next_sel = None
+        next_story = None
+        next_sel = None
 
-            if prev_obj != None:
-                prev_obj.next_obj = tag
+        for obj, sel in self._span_objs(hi, len(self.spans)):
+            if next_story is None and not obj.is_tag:
+                next_story = obj
+            if next_sel is None and sel:
+                next_sel = obj
+            if next_story is not None and next_sel is not None:
+                break
 
-            prev_obj = tag
+        # Forward, setting prev pointers.
 
-            # Collapsed tags (with items) skip stories.
-            if self.callbacks["get_tag_opt"](tag.tag, "collapsed"):
-                if prev_sel:
-                    prev_sel.next_sel = tag
-                prev_sel = tag
-                continue
+        for obj, sel in self._span_objs(lo, hi):
+            obj.curpos = self.height
 
-            for story in tag:
-                story.curpos = self.height
+            obj.prev_obj = prev_obj
+            if prev_obj != None:
+                prev_obj.next_obj = obj
+            prev_obj = obj
+
+            obj.prev_story = prev_story
+            obj.prev_sel = prev_sel
+
+            if not obj.is_tag:
+                prev_story = obj
+            if sel:
+                prev_sel = obj
+
+        prev_obj.next_obj = next_obj
+        if next_obj != None:
+            next_obj.prev_obj = prev_obj
+
+        fix_story = fix_sel = True
+        for obj, sel in self._span_objs(hi, len(self.spans)):
+            if fix_story:
+                obj.prev_story = prev_story
+            if fix_sel:
+                obj.prev_sel = prev_sel
+            if not obj.is_tag:
+                fix_story = False
+            if sel:
+                fix_sel = False
+            if not (fix_story or fix_sel):
+                break
 
-                if not self.first_story:
-                    self.first_story = story
+        # Backward, setting next pointers. We want next_story to be accessible
+        # from all objects, but next_sel only from selectable ones.
 
-                story.prev_obj = prev_obj
-                story.next_obj = None
-                prev_obj.next_obj = story
-                prev_obj = story
+        for obj, sel in self._span_objs(lo, hi, True):
+            obj.next_story = next_story
+            if sel:
+                obj.next_sel = next_sel
+            else:
+                obj.next_sel = None
+
+            if not obj.is_tag:
+                next_story = obj
+            if sel:
+                next_sel = obj
+
+        fix_story = fix_sel = True
+        for obj, sel in self._span_objs(0, lo, True):
+            if fix_story:
+                obj.next_story = next_story
+            if fix_sel and sel:
+                obj.next_sel = next_sel
+            if not obj.is_tag:
+                fix_story = False
+            if sel:
+                fix_sel = False
+            if not (fix_story or fix_sel):
+                break
 
-                if prev_story != None:
-                    prev_story.next_story = story
-                story.prev_story = prev_story
-                story.next_story = None
-                prev_story = story
+    # Get an object's pads, making it the most recently used in the pool and
+    # evicting the least recently used past the pool size.
 
-                # We want next_story to be accessible from all objects, so head
-                # back and set it for any without one, even if it wasn't the
-                # last story object (i.e. if it's a tag)
+    def _pads(self, obj):
+        lines = obj.pads(self.width)
 
-                cur = story.prev_obj
-                while cur and cur.next_story == None:
-                    cur.next_story = story
-                    cur = cur.prev_obj
+        key = id(obj)
+        if key in self.pad_pool:
+            self.pad_pool.move_to_end(key)
+        else:
+            self.pad_pool[key] = obj
 
-                if prev_sel != None:
-                    prev_sel.next_sel = story
-                story.prev_sel = prev_sel
-                story.next_sel = None
-                prev_sel = story
+        while len(self.pad_pool) > self.pad_pool_size:
+            key, old = self.pad_pool.popitem(False)
+            old.unpad()
 
-                # Keep track of last story.
-                self.last_story = story
+        return lines
 
-        self.callbacks["set_var"]("needs_redraw", True)
+    def _unpool(self, objs):
+        for obj in objs:
+            if self.pad_pool.pop(id(obj), None) is not None:
+                obj.unpad()
 
     # curpos - position in visible windown, can be negative
     # main_offset - starting line from top of pad
 
     def _partial_render(self, obj, main_offset, curpos, footer = False):
-        lines = obj.pads(self.width)
+        lines = self._pads(obj)
         pad = obj.pad
 
         if footer:
@@ -1076,16 +1662,48 @@ class TagList(GuiBase):
 
         return (main_offset, curpos + lines)
 
+    # Find the object that will be at the top of the screen if target_obj is
+    # target_offset lines down, along with its (<= 0) position. The objects in
+    # between are laid out, and if that changes their line counts we look
+    # again.
+
+    def _find_top(self, target_obj, target_offset):
+        while True:
+            top = self._line_of(target_obj) - target_offset
+
+            obj = self._obj_at(max(top, 0))
+
+            changed = False
+            o = obj
+            while o is not None and o is not target_obj:
+                if self._set_lines(o, o.lines(self.width)):
+                    changed = True
+                o = o.next_obj
+
+            if not changed:
+                return (obj, self._line_of(obj) - top)
+
     def redraw(self):
         log.debug("Taglist REDRAW (%s)!\n", self.width)
         self.pad.erase()
 
+        # Never pool fewer pads than it takes to fill the screen and the
+        # prelayout on either side, or we'd be replaying layouts on every
+        # redraw.
+
+        prelayout_lines = self.callbacks["get_opt"]("taglist.prelayout") * self.height
+
+        self.pad_pool_size = max(self.callbacks["get_opt"]("taglist.pad_pool"),\
+                2 * prelayout_lines + self.height + 1)
+
         target_obj = self.callbacks["get_var"]("target_obj")
         target_offset = self.callbacks["get_var"]("target_offset")
 
         # Bail if we have no item.
 
         if target_obj == None:
+            self.prelayout_above = None
+            self.prelayout_below = None
             self.pad.addstr("All tags empty.")
             self.callbacks["refresh"]()
             return
@@ -1100,7 +1718,7 @@ class TagList(GuiBase):
 
         if not target_obj.is_tag:
             tag = target_obj.parent_tag
-            tl = tag.lines(self.width)
+            tl = self._lines(tag)
             if target_offset < tl:
                 target_offset = tl
         elif target_offset < 0:
@@ -1109,7 +1727,7 @@ class TagList(GuiBase):
         # If we're trying to render too close to the bottom, we also
         # need an adjustment.
 
-        tol = target_obj.lines(self.width)
+        tol = self._lines(target_obj)
         if target_offset > ((self.height - 1) - tol):
             target_offset = (self.height - 1) - tol
 
@@ -1121,9 +1739,12 @@ class TagList(GuiBase):
         curpos = target_offset
         top_adjusted = False
 
+        if curpos > 0 and self._locate(target_obj):
+            obj, curpos = self._find_top(target_obj, target_offset)
+
         while curpos > 0:
             if obj.prev_obj:
-                curpos -= obj.prev_obj.lines(self.width)
+                curpos -= self._lines(obj.prev_obj)
                 obj = obj.prev_obj
 
             # If there aren't enough items to render before this item and
@@ -1142,7 +1763,7 @@ class TagList(GuiBase):
 
         while last_off < (self.height - 1):
             if last_obj:
-                last_off += last_obj.lines(self.width)
+                last_off += self._lines(last_obj)
                 last_obj = last_obj.next_obj
 
             # Not enough items to render after our item,
@@ -1185,12 +1806,13 @@ class TagList(GuiBase):
 
         # Step 4. Render.
 
+        first_obj = obj
         rendered_header = False
         w_offset = 0
 
         while obj != None:
             # Refresh if necessary, update curpos for scrolling.
-            obj.lines(self.width)
+            self._lines(obj)
             obj.curpos = curpos
 
             # Copy item into window
@@ -1204,7 +1826,7 @@ class TagList(GuiBase):
             if not rendered_header and curpos > 0:
                 tag = self.tag_by_obj(obj)
 
-                if curpos >= tag.lines(self.width):
+                if curpos >= self._lines(tag):
                     self._partial_render(tag, 0, 0)
                     rendered_header = True
 
@@ -1218,7 +1840,7 @@ class TagList(GuiBase):
                     tag = obj
                 else:
                     tag = self.tag_by_item(obj)
-                    tag.lines(self.width)
+                    self._lines(tag)
                     obj.extra_lines = tag.footlines
 
                 w_offset, curpos = self._partial_render(tag, w_offset, curpos, True)
@@ -1235,8 +1857,57 @@ class TagList(GuiBase):
 
             obj = obj.next_obj
 
+        # Step 5. Point idle prelayout at the objects just off screen.
+
+        self.prelayout_above = first_obj.prev_obj
+        self.prelayout_above_lines = prelayout_lines
+        self.prelayout_below = obj.next_obj if obj is not None else None
+        self.prelayout_below_lines = prelayout_lines
+
         self.callbacks["refresh"]()
 
+    # Lay out and pad one object near the screen, so that when it's scrolled
+    # into view redraw has nothing to do but copy it. Alternates between
+    # below and above the screen, favoring the side with the most left to do.
+
+    def prelayout(self):
+        below = self.prelayout_below is not None and self.prelayout_below_lines > 0
+        above = self.prelayout_above is not None and self.prelayout_above_lines > 0
+
+        # The pointers are from the last redraw, so if a story has died since,
+        # its links are stale and that side is done until the next one.
+
+        if below and (not above or\
+                self.prelayout_below_lines >= self.prelayout_above_lines):
+            obj = self.prelayout_below
+            if not obj.is_tag and obj.is_dead:
+                self.prelayout_below = None
+            else:
+                self.prelayout_below = obj.next_obj
+                self.prelayout_below_lines -= self._prelayout_obj(obj)
+        elif above:
+            obj = self.prelayout_above
+            if not obj.is_tag and obj.is_dead:
+                self.prelayout_above = None
+            else:
+                self.prelayout_above = obj.prev_obj
+                self.prelayout_above_lines -= self._prelayout_obj(obj)
+        else:
+            return False
+
+        return True
+
+    def _prelayout_obj(self, obj):
+
+        # Stories that are still waiting on content would just trigger a sync
+        # and show a placeholder, leave them to the real redraw.
+
+        if obj.is_tag or obj.ready():
+            lines = self._pads(obj)
+            self._set_lines(obj, lines)
+            return lines
+        return 1
+
     def is_input(self):
         return False
 
@@ -8,7 +8,7 @@
 
 from canto_next.hooks import on_hook, unhook_all
 
-from .theme import FakePad, WrapPad, theme_print, theme_lstrip, theme_border, theme_reset
+from .theme import FakePad, WrapPad, ThemeContext, theme_print, theme_print_at, theme_lstrip_at, theme_border
 from .command import register_commands, unregister_command
 from .guibase import GuiBase
 from .color import cc
@@ -54,11 +54,11 @@ class TextBox(GuiBase):
         self.height, self.width = self.pad.getmaxyx()
 
         fp = FakePad(self.width)
-        lines = self.render(fp)
+        lines = self.render(fp, ThemeContext())
 
-        # Create pre-rendered pad
+        # Create pre-rendered pad from the layout
         self.fullpad = curses.newpad(lines, self.width)
-        self.render(WrapPad(self.fullpad))
+        fp.replay(WrapPad(self.fullpad))
 
         # Update offset based on new display properties.
         self.max_offset = max((lines - 1) - (self.height - 1), 0)
@@ -76,10 +76,12 @@ class TextBox(GuiBase):
 
         realheight = min(self.height, self.fullpad.getmaxyx()[0]) - 1
 
+        ctx = ThemeContext()
+
         top = 0
         if tb:
             self.pad.move(0, 0)
-            self.render_top_border(WrapPad(self.pad))
+            self.render_top_border(WrapPad(self.pad), ctx)
             top += 1
 
         self.fullpad.overwrite(self.pad, offset, 0, top, 0,\
@@ -92,18 +94,18 @@ class TextBox(GuiBase):
             if not self.callbacks["floating"]():
                 padheight = self.pad.getmaxyx()[0] -1
                 self.pad.move(padheight - 1, 0)
-                self.render_bottom_border(WrapPad(self.pad))
+                self.render_bottom_border(WrapPad(self.pad), ctx)
                 self.pad.move(padheight - 1, 0)
             else:
                 self.pad.move(realheight - 1, 0)
-                self.render_bottom_border(WrapPad(self.pad))
+                self.render_bottom_border(WrapPad(self.pad), ctx)
                 self.pad.move(realheight - 1, 0)
         else:
             self.pad.move(realheight - 1, 0)
 
         self.callbacks["refresh"]()
 
-    def render_top_border(self, pad):
+    def render_top_border(self, pad, ctx):
         tb, lb, bb, rb = self.callbacks["border"]()
 
         lc = " "
@@ -115,9 +117,9 @@ class TextBox(GuiBase):
             rc = "%C" + theme_border("tr") + "%c"
 
         mainbar = "%C" + (theme_border("ts") * (self.width - 1)) + "%c"
-        theme_print(pad, mainbar, self.width, lc, rc)
+        theme_print(pad, ctx, mainbar, self.width, lc, rc)
 
-    def render_bottom_border(self, pad):
+    def render_bottom_border(self, pad, ctx):
         tb, lb, bb, rb = self.callbacks["border"]()
 
         lc = " "
@@ -129,9 +131,9 @@ class TextBox(GuiBase):
             rc = "%C" + theme_border("br") + "%c"
 
         mainbar = "%C" + (theme_border("ts") * (self.width - 1)) + "%c"
-        theme_print(pad, mainbar, self.width, lc, rc)
+        theme_print(pad, ctx, mainbar, self.width, lc, rc)
 
-    def render(self, pad):
+    def render(self, pad, ctx):
         self.update_text()
 
         tb, lb, bb, rb = self.callbacks["border"]()
@@ -154,18 +156,26 @@ class TextBox(GuiBase):
 
         # Render main content
 
-        while s:
+        # Work from offsets into s, so long bodies are wrapped in one pass,
+        # instead of re-handling the remainder of the string for each line.
+
+        pos = 0 if s else None
+        while pos != None:
             if self.lstrip:
-                s = theme_lstrip(pad, s)
-            if s:
-                s = theme_print(pad, s, self.width, l, r)
-                lines += 1
+                pos, newline = theme_lstrip_at(pad, ctx, s, pos)
+                if pos >= len(s):
+                    break
+                if newline:
+                    theme_print(pad, ctx, "", self.width, l, r)
+                    lines += 1
+            pos = theme_print_at(pad, ctx, s, pos, self.width, l, r)
+            lines += 1
 
         # Account for potential bottom rendered on redraw.
         if bb:
             lines += 1
 
-        theme_reset()
+        ctx.reset()
 
         # Return one extra line because the rest of the reader
         # code knows to avoid the dead cell on the bottom right
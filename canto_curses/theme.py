@@ -6,23 +6,20 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
-from canto_next.encoding import encoder, locale_enc
-from .widecurse import waddch, wcwidth
+from canto_next.encoding import locale_enc
+from .widecurse import waddnwstr, wcwidths
 from .html import html_entity_convert, char_ref_convert
 from .config import config
 
+from collections import OrderedDict
+from functools import lru_cache
+from bisect import bisect_left
 import curses
 
 import logging
 
 log = logging.getLogger("WIDECURSE")
 
-attr_count = { "B" : 0,
-               "D" : 0,
-               "R" : 0,
-               "S" : 0,
-               "U" : 0 }
-
 attr_map = { "B" : curses.A_BOLD,
              "D" : curses.A_DIM,
              "R" : curses.A_REVERSE,
@@ -33,38 +30,239 @@ attr_map = { "B" : curses.A_BOLD,
 #   %1 - %8 turns on color pairs 1 - 8
 #   %0      turns on the previously enabled color
 
-color_stack = []
-color_stack_suspended = []
+# The state that theme codes build up (attribute nesting and the color stack)
+# lives in a ThemeContext, which is passed through every theme_* call, so
+# independent renders don't share anything and a render starts from a clean
+# slate. A context should be used for one object's render at a time.
+
+class ThemeContext():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.attr_count = { "B" : 0,
+                            "D" : 0,
+                            "R" : 0,
+                            "S" : 0,
+                            "U" : 0 }
+        self.color_stack = []
+        self.color_stack_suspended = []
+
+# Themed strings are compiled into a tuple of tokens once, and kept in a
+# bounded LRU keyed by the string, so redrawing an unchanged title doesn't
+# re-parse its codes or re-measure every character.
+
+THEME_CACHE_SIZE = 8192
+
+TOK_TEXT = 0        # (TOK_TEXT, pos, text, widths, total width, advance)
+TOK_SPACE = 1       # (TOK_SPACE, pos, char, width, next word width)
+TOK_ESCAPE = 2      # (TOK_ESCAPE, pos, char, width)
+TOK_NEWLINE = 3     # (TOK_NEWLINE, pos)
+TOK_COLOR = 4       # (TOK_COLOR, pos, pair)
+TOK_LONG_COLOR = 5  # (TOK_LONG_COLOR, pos, pair)
+TOK_POP_COLOR = 6   # (TOK_POP_COLOR, pos)
+TOK_ATTR_ON = 7     # (TOK_ATTR_ON, pos, attr)
+TOK_ATTR_OFF = 8    # (TOK_ATTR_OFF, pos, attr)
+TOK_SUSPEND = 9     # (TOK_SUSPEND, pos)
+TOK_RESTORE = 10    # (TOK_RESTORE, pos)
+
+# pos is the offset of the token in the original string, so that a partially
+# printed string can be resumed (or hand back its unprinted remainder).
+
+# Whitespace that's printed even though wcwidth() is -1.
+
+ASCII_SPACE = " \t\n\r\x0b\x0c"
+
+# Text runs contain no codes, so they're written to the pad with a single
+# waddnwstr. Total width only counts printing characters, advance is how far
+# the old per-character loop moved (whitespace like tabs counts as -1).
+
+def _text_token(pos, text, widths):
+    return (TOK_TEXT, pos, text, widths,\
+            sum(w for w in widths if w > 0), sum(widths))
+
+# Returns (tokens, printed length, token offsets)
+
+# Break opportunities are found in the same forward pass: each space token
+# carries the printed width of the word after it (up to the next space,
+# escaped or not), so wrapping never has to look ahead.
+
+@lru_cache(maxsize=THEME_CACHE_SIZE)
+def theme_compile(uni):
+    tokens = []
+    length = 0
+
+    escaped = False
+    esc_pos = 0
+    code = False
+    code_pos = 0
+
+    long_code = False
+    lc = ""
+
+    # Start of the current text run, or -1
+    run_pos = -1
+
+    # Measure the whole string in one call.
+    widths = wcwidths(uni)
+
+    # Index of the last space token, and the width of the word since.
+    space = -1
+    word = 0
 
-# Return length of next string of non-space characters
-# or 0 if next character *is* a space.
+    for i, c in enumerate(uni):
+        cwidth = widths[i]
+        printable = cwidth >= 0 or c in ASCII_SPACE
+
+        # Runs must be contiguous in the original string.
+
+        if run_pos >= 0 and (not printable or escaped or code or long_code\
+                or c in "\\% \n"):
+            tok = _text_token(run_pos, uni[run_pos:i], widths[run_pos:i])
+            tokens.append(tok)
+            word += tok[4]
+            run_pos = -1
 
-def len_next_word(uni):
-    if ' ' in uni:
-        return theme_len(uni.split(' ', 1)[0])
-    return theme_len(uni)
+        if not printable:
+            continue
+
+        if escaped:
+            if c == " ":
+                if space >= 0:
+                    tokens[space] += (word,)
+                space = -1
+                word = 0
+            else:
+                word += max(cwidth, 0)
+
+            tokens.append((TOK_ESCAPE, esc_pos, c, cwidth))
+            length += max(cwidth, 0)
+            escaped = False
+        elif code:
+            if c in "12345678":
+                tokens.append((TOK_COLOR, code_pos, ord(c) - ord('0')))
+            elif c == '0':
+                tokens.append((TOK_POP_COLOR, code_pos))
+            elif c in "BDRSU":
+                tokens.append((TOK_ATTR_ON, code_pos, c))
+            elif c in "bdrsu":
+                tokens.append((TOK_ATTR_OFF, code_pos, c.upper()))
+            elif c == "C":
+                tokens.append((TOK_SUSPEND, code_pos))
+            elif c == "c":
+                tokens.append((TOK_RESTORE, code_pos))
+            elif c == "[":
+                long_code = True
+            code = False
+        elif long_code:
+            if c == "]":
+                try:
+                    long_color = int(lc)
+                except:
+                    log.error("Unknown long code: %s! Ignoring..." % lc)
+                else:
+                    if long_color < 1 or long_color > 256:
+                        log.error("long color code must be >= 1 and <= 256")
+                    else:
+                        tokens.append((TOK_LONG_COLOR, code_pos, long_color))
+                long_code = False
+                lc = ""
+            else:
+                lc += c
+        elif c == "\\":
+            escaped = True
+            esc_pos = i
+        elif c == "%":
+            code = True
+            code_pos = i
+        elif c == "\n":
+            tokens.append((TOK_NEWLINE, i))
+        elif c == " ":
+            if space >= 0:
+                tokens[space] += (word,)
+            space = len(tokens)
+            word = 0
+
+            tokens.append((TOK_SPACE, i, c, cwidth))
+            length += cwidth
+        else:
+            if run_pos < 0:
+                run_pos = i
+            if cwidth > 0:
+                length += cwidth
+
+    if run_pos >= 0:
+        tok = _text_token(run_pos, uni[run_pos:], widths[run_pos:])
+        tokens.append(tok)
+        word += tok[4]
+
+    if space >= 0:
+        tokens[space] += (word,)
+
+    return (tuple(tokens), length, tuple(tok[1] for tok in tokens))
+
+# Find where to resume a compiled string at offset start. Returns the token
+# index, and the character index into that token if it's a partially printed
+# text run.
+
+def _theme_seek(tokens, starts, start):
+    idx = bisect_left(starts, start)
+    if idx > 0:
+        prev = tokens[idx - 1]
+        if prev[0] == TOK_TEXT and start < prev[1] + len(prev[2]):
+            return (idx - 1, start - prev[1])
+    return (idx, 0)
+
+# Rather than toggling attributes on the pad for every code, the pads track the
+# current attribute word themselves, the way curses' wattron/wattroff combine
+# them (a color pair replaces the previous pair instead of being OR'd in), and
+# text is written in (text, attr) runs with the attribute set directly.
+
+def attr_on(cur, attr):
+    if attr & curses.A_COLOR:
+        cur &= ~curses.A_COLOR
+    return cur | attr
+
+def attr_off(cur, attr):
+    if attr & curses.A_COLOR:
+        cur &= ~curses.A_COLOR
+    return cur & ~(attr & ~curses.A_COLOR)
+
+# FakePad is the layout pass. It tracks the cursor like a real pad would, and
+# records every operation into a display list, so the result can be painted
+# onto a real pad later with replay(), without wrapping the text again.
+# Adjacent writes with the same attributes are merged into one run.
 
 class FakePad():
     def __init__(self, width):
         self.x = 0
         self.y = 0
         self.width = width
+        self.attr = 0
+        self.ops = []
 
     def attron(self, attr):
-        pass
+        self.attr = attr_on(self.attr, attr)
 
     def attroff(self, attr):
-        pass
+        self.attr = attr_off(self.attr, attr)
 
     def clrtoeol(self):
-        pass
+        self.ops.append(("clrtoeol", ()))
 
-    def waddch(self, ch):
-        cwidth = wcwidth(ch)
-        if cwidth < 0 and not ch.is_space():
-            return
+    # Callers only pass printable runs that fit on the current line.
 
-        self.x += cwidth
+    def waddnwstr(self, s):
+        if self.ops:
+            name, args = self.ops[-1]
+            if name == "addstr" and args[1] == self.attr:
+                self.ops[-1] = (name, (args[0] + s, self.attr))
+            else:
+                self.ops.append(("addstr", (s, self.attr)))
+        else:
+            self.ops.append(("addstr", (s, self.attr)))
+
+        self.x += sum(wcwidths(s))
         if self.x >= self.width:
             self.y += 1
             self.x -= self.width
@@ -73,24 +271,97 @@ class FakePad():
         return (self.y, self.x)
 
     def move(self, y, x):
+        self.ops.append(("move", (y, x)))
         self.y = y
         self.x = x
 
+    def replay(self, pad):
+        for name, args in self.ops:
+            try:
+                getattr(pad, name)(*args)
+            except Exception as e:
+                log.debug("Replay %s%s failed: %s", name, args, e)
+
+# Stories and tags keep their layouts for the last few widths they were
+# rendered at, so toggling between widths (tmux zoom, tiling WMs) doesn't
+# re-wrap everything. On top of the per-object limit, the total size of all
+# cached layouts (in display list ops) is capped, oldest evicted first.
+
+LAYOUT_WIDTHS = 3
+LAYOUT_MAX_OPS = 250000
+
+layout_lru = OrderedDict()
+layout_ops = 0
+
+class LayoutCache():
+    def __init__(self):
+        self.layouts = OrderedDict()
+
+    def get(self, width):
+        if width not in self.layouts:
+            return None
+
+        self.layouts.move_to_end(width)
+        layout_lru.move_to_end((self, width))
+        return self.layouts[width]
+
+    def put(self, width, layout, size):
+        global layout_ops
+
+        self.drop(width)
+
+        self.layouts[width] = layout
+        layout_lru[(self, width)] = size
+        layout_ops += size
+
+        while len(self.layouts) > LAYOUT_WIDTHS:
+            self.drop(next(iter(self.layouts)))
+
+        while layout_ops > LAYOUT_MAX_OPS and len(layout_lru) > 1:
+            cache, old_width = next(iter(layout_lru))
+            cache.drop(old_width)
+
+    def drop(self, width):
+        global layout_ops
+
+        if width in self.layouts:
+            del self.layouts[width]
+            layout_ops -= layout_lru.pop((self, width))
+
+    def clear(self):
+        for width in list(self.layouts.keys()):
+            self.drop(width)
+
+# Return (cached layouts, total ops, max ops)
+
+def layout_stats():
+    return (len(layout_lru), layout_ops, LAYOUT_MAX_OPS)
+
 class WrapPad():
     def __init__(self, pad):
         self.pad = pad
+        self.attr = 0
+
+        # Attributes last set on the real pad, None forces the first set.
+        self.pad_attr = None
 
     def attron(self, attr):
-        self.pad.attron(attr)
+        self.attr = attr_on(self.attr, attr)
 
     def attroff(self, attr):
-        self.pad.attroff(attr)
+        self.attr = attr_off(self.attr, attr)
 
     def clrtoeol(self):
         self.pad.clrtoeol()
 
-    def waddch(self, ch):
-        waddch(self.pad, ch)
+    def waddnwstr(self, s):
+        self.addstr(s, self.attr)
+
+    def addstr(self, s, attr):
+        if attr != self.pad_attr:
+            self.pad.attrset(attr)
+            self.pad_attr = attr
+        waddnwstr(self.pad, s)
 
     def getyx(self):
         return self.pad.getyx()
@@ -98,152 +369,160 @@ class WrapPad():
     def move(self, x, y):
         return self.pad.move(x, y)
 
-def theme_print_one(pad, uni, width):
-    global color_stack
-    global attr_count
-    global attr_map
+# Apply a single compiled code token to the pad.
+
+def theme_code(pad, ctx, tok):
+    attr_count = ctx.attr_count
+    color_stack = ctx.color_stack
+
+    op = tok[0]
+
+    # Turn on color 1 - 8
+    if op == TOK_COLOR:
+        if len(color_stack):
+            pad.attroff(curses.color_pair(color_stack[-1]))
+        color_stack.append(tok[2])
+        pad.attron(curses.color_pair(color_stack[-1]))
+
+    # Turn on color 1 - 256
+    elif op == TOK_LONG_COLOR:
+        try:
+            pad.attron(curses.color_pair(tok[2]))
+            color_stack.append(tok[2])
+        except:
+            log.error("Could not set pair. Perhaps need to set TERM='xterm-256color'?")
+
+    # Return to previous color
+    elif op == TOK_POP_COLOR:
+        if len(color_stack):
+            pad.attroff(curses.color_pair(color_stack[-1]))
+
+        if len(color_stack) >= 2:
+            pad.attron(curses.color_pair(color_stack[-2]))
+            color_stack.pop()
+        else:
+            pad.attron(curses.color_pair(0))
+            del color_stack[:]
+
+    # Turn attributes on / off
+    elif op == TOK_ATTR_ON or op == TOK_ATTR_OFF:
+        c = tok[2]
+        if op == TOK_ATTR_ON:
+            attr_count[c] += 1
+        else:
+            attr_count[c] -= 1
+
+        if attr_count[c]:
+            pad.attron(attr_map[c])
+        else:
+            pad.attroff(attr_map[c])
+
+    # Suspend attributes
+    elif op == TOK_SUSPEND:
+        for attr in attr_map:
+            pad.attroff(attr_map[attr])
+        for color in reversed(color_stack):
+            pad.attroff(curses.color_pair(color))
+        pad.attron(curses.color_pair(0))
+        ctx.color_stack_suspended = color_stack
+        ctx.color_stack = []
+
+    # Restore attributes
+    elif op == TOK_RESTORE:
+        for attr in attr_map:
+            if attr_count[attr]:
+                pad.attron(attr_map[attr])
+        ctx.color_stack = ctx.color_stack_suspended
+        ctx.color_stack_suspended = []
+        if ctx.color_stack:
+            pad.attron(curses.color_pair(ctx.color_stack[-1]))
+        else:
+            pad.attron(curses.color_pair(0))
+
+def _theme_addstr(pad, text, uni):
+    try:
+        pad.waddnwstr(text)
+    except Exception as e:
+        log.debug("Can't print %s in: %s", repr(text), repr(uni))
+        log.debug("Exception: %s", e)
 
+# Print as much of uni as fits in width, starting at offset start. Returns the
+# offset to continue from, or None if the whole string was printed.
+
+def theme_print_one(pad, ctx, uni, width, start=0):
     max_width = width
-    escaped = False
-    code = False
+    tokens, length, starts = theme_compile(uni)
 
-    long_code = False
-    lc = ""
+    idx, skip = _theme_seek(tokens, starts, start)
 
-    for i, c in enumerate(uni):
-        ec = encoder(c)
-        cwidth = wcwidth(ec)
-        if cwidth < 0 and not ec.isspace():
-            continue
+    for idx in range(idx, len(tokens)):
+        tok = tokens[idx]
+        op = tok[0]
 
-        if escaped:
-            # No room
-            if cwidth > width:
-                return "\\" + uni[i:]
+        if op == TOK_TEXT:
+            # Whole run fits, the common case.
+            if not skip and tok[4] <= width:
+                _theme_addstr(pad, tok[2], uni)
+                width -= tok[5]
+                continue
 
-            try:
-                pad.waddch(ec)
-            except:
-                log.debug("Can't print escaped ec: %s in: %s", ec, uni)
+            widths = tok[3]
 
-            width -= cwidth
-            escaped = False
-        elif code:
-            # Turn on color 1 - 8
-            if c in "12345678":
-                if len(color_stack):
-                    pad.attroff(curses.color_pair(color_stack[-1]))
-                color_stack.append(ord(c) - ord('0'))
-                pad.attron(curses.color_pair(color_stack[-1]))
-            # Return to previous color
-            elif c == '0':
-                if len(color_stack):
-                    pad.attroff(curses.color_pair(color_stack[-1]))
+            i = skip
+            while i < len(widths) and widths[i] <= width:
+                width -= widths[i]
+                i += 1
 
-                if len(color_stack) >= 2:
-                    pad.attron(curses.color_pair(color_stack[-2]))
-                    color_stack = color_stack[0:-1]
-                else:
-                    pad.attron(curses.color_pair(0))
-                    color_stack = []
+            if i > skip:
+                _theme_addstr(pad, tok[2][skip:i], uni)
 
-            # Turn attributes on / off
-            elif c in "BbDdRrSsUu":
-                if c.isupper():
-                    attr_count[c] += 1
-                else:
-                    c = c.upper()
-                    attr_count[c] -= 1
+            # Character too long (should be handled by word wrap).
+            if i < len(widths):
+                return tok[1] + i
+            skip = 0
 
-                if attr_count[c]:
-                    pad.attron(attr_map[c])
-                else:
-                    pad.attroff(attr_map[c])
+        elif op == TOK_SPACE:
+            # Word too long, >= to account for current character
+            if tok[4] <= max_width and tok[4] >= width:
+                return tok[1] + 1
 
-            # Suspend attributes
-            elif c == "C":
-                for attr in attr_map:
-                    pad.attroff(attr_map[attr])
-                for color in reversed(color_stack):
-                    pad.attroff(curses.color_pair(color))
-                pad.attron(curses.color_pair(0))
-                color_stack_suspended = color_stack
-                color_stack = []
-
-            # Restore attributes
-            elif c == "c":
-                for attr in attr_map:
-                    if attr_count[attr]:
-                        pad.attron(attr_map[attr])
-                color_stack = color_stack_suspended
-                color_stack_suspended = []
-                if color_stack:
-                    pad.attron(curses.color_pair(color_stack[-1]))
-                else:
-                    pad.attron(curses.color_pair(0))
-            elif c == "[":
-                long_code = True
-            code = False
-        elif long_code:
-            if c == "]":
-                try:
-                    long_color = int(lc)
-                except:
-                    log.error("Unknown long code: %s! Ignoring..." % lc)
-                else:
-                    if long_color < 1 or long_color > 256:
-                        log.error("long color code must be >= 1 and <= 256")
-                    else:
-                        try:
-                            pad.attron(curses.color_pair(long_color))
-                            color_stack.append(long_color)
-                        except:
-                            log.error("Could not set pair. Perhaps need to set TERM='xterm-256color'?")
-                long_code = False
-                lc = ""
-            else:
-                lc += c
-        elif c == "\\":
-            escaped = True
-        elif c == "%":
-            code = True
-        elif c == "\n":
-            return uni[i + 1:]
-        else:
-            if c == " ":
-                # Word too long
-                wwidth = len_next_word(uni[i + 1:])
+            if tok[3] > width:
+                return tok[1]
 
-                # >= to account for current character
-                if wwidth <= max_width and wwidth >= width:
-                    return uni[i + 1:]
+            _theme_addstr(pad, tok[2], uni)
+            width -= tok[3]
 
-            # Character too long (should be handled above).
-            if cwidth > width:
-                return uni[i:]
+        elif op == TOK_ESCAPE:
+            # No room, pos points at the backslash.
+            if tok[3] > width:
+                return tok[1]
 
-            try:
-                pad.waddch(ec)
-            except Exception as e:
-                log.debug("Can't print ec: %s in: %s", ec, repr(encoder(uni)))
-                log.debug("Exception: %s", e)
+            _theme_addstr(pad, tok[2], uni)
+            width -= tok[3]
+
+        elif op == TOK_NEWLINE:
+            return tok[1] + 1
 
-            width -= cwidth
+        else:
+            theme_code(pad, ctx, tok)
 
     return None
 
-def theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=True):
+# Print one line of uni, from offset start, with pre and post borders. Returns
+# the offset of the unprinted remainder, or None if there's nothing left.
+
+def theme_print_at(pad, ctx, uni, start, mwidth, pre = "", post = "", cursorbash=True, clear=True):
     prel = theme_len(pre)
     postl = theme_len(post)
     y = pad.getyx()[0]
 
-    theme_print_one(pad, pre, prel)
+    theme_print_one(pad, ctx, pre, prel)
 
     width = (mwidth - prel) - postl
     if width <= 0:
         raise Exception("theme_print: NO ROOM!")
 
-    r = theme_print_one(pad, uni, width)
+    r = theme_print_one(pad, ctx, uni, width, start)
 
     if clear:
         pad.clrtoeol()
@@ -253,7 +532,7 @@ def theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=Tr
             pad.move(y, (mwidth - postl))
         except:
             log.debug("move error: %d %d", y, mwidth - postl)
-        theme_print_one(pad, post, postl)
+        theme_print_one(pad, ctx, post, postl)
 
     if cursorbash:
         try:
@@ -261,106 +540,90 @@ def theme_print(pad, uni, mwidth, pre = "", post = "", cursorbash=True, clear=Tr
         except:
             pass
 
-    if r == uni:
+    if r == start:
         raise Exception("theme_print: didn't advance!")
 
+    if r != None and r >= len(uni):
+        return None
     return r
 
+# String based version of theme_print_at, returns the unprinted remainder.
+
+def theme_print(pad, ctx, uni, mwidth, pre = "", post = "", cursorbash=True, clear=True):
+    r = theme_print_at(pad, ctx, uni, 0, mwidth, pre, post, cursorbash, clear)
+    if r == None:
+        return None
+    return uni[r:]
+
 # Returns the effective, printed length of a string, taking
 # escapes and wide characters into account.
 
 def theme_len(uni):
-    escaped = False
-    code = False
-    length = 0
-
-    for c in uni:
-        ec = encoder(c)
-
-        cwidth = wcwidth(ec)
-        if cwidth < 0 and not ec.isspace():
-            continue
-
-        if escaped:
-            length += cwidth
-            escaped = False
-        elif code:
-            code = False
-        elif c == "\\":
-            escaped = True
-        elif c == "%":
-            code = True
-        else:
-            width = cwidth
-            if width >= 0:
-                length += width
-    return length
+    return theme_compile(uni)[1]
 
 # This is useful when a themed string needs to get truncated, so that color and
 # attribute settings can be processed, despite the last part of the string not
 # being displayed.
 
-def theme_process(pad, uni):
-    only_codes = ""
-    escaped = False
-    code = False
+def theme_process(pad, ctx, uni):
+    for tok in theme_compile(uni)[0]:
+        if tok[0] >= TOK_COLOR:
+            theme_code(pad, ctx, tok)
 
-    for c in uni:
-        if escaped:
-            escaped = False
-            continue
-        elif code:
-            only_codes += c
-            code = False
-        elif c == "\\":
-            escaped = True
-        elif c == "%":
-            code = True
-            only_codes += "%"
+# Strip more than two newlines from the front of the input, from offset start,
+# processing escapes as we discard characters. Returns the offset of the
+# remaining content, and whether a newline should be printed before it.
 
-    # NOTE: len works because codes never use widechars.
-    theme_print(pad, only_codes, len(only_codes), "", "", False)
+def theme_lstrip_at(pad, ctx, uni, start):
+    newlines = 0
+    codes = []
 
-# Strip more than two newlines from the front of the input, processing escapes
-# as we discard characters.
+    tokens, length, starts = theme_compile(uni)
+    idx, skip = _theme_seek(tokens, starts, start)
 
-def theme_lstrip(pad, uni):
-    newlines = 0
-    codes = ""
-    escaped = False
+    # By index, slicing tokens would copy the rest of them for every line.
+
+    for idx in range(idx, len(tokens)):
+        tok = tokens[idx]
+        op = tok[0]
 
-    for i, c in enumerate(uni):
         # Discard
-        if c in " \t\v":
+        if op == TOK_SPACE:
             continue
 
-        if c == "\n":
+        if op == TOK_NEWLINE:
             newlines = 1
-        elif c == "%":
-            escaped = True
-            codes += "%"
-        elif escaped:
-            escaped = False
-            codes += c
+        elif op >= TOK_COLOR:
+            codes.append(tok)
+        elif op == TOK_TEXT:
+            for i in range(skip, len(tok[2])):
+                if tok[2][i] not in "\t\v":
+                    r = tok[1] + i
+                    break
+            else:
+                skip = 0
+                continue
+            break
         else:
-            r = uni[i:]
+            r = tok[1]
             break
 
     # No content found.
     else:
         newlines = 0
-        r = ""
+        r = len(uni)
 
     # Process dangling codes.
-    if codes:
-        theme_process(pad, codes)
+    for tok in codes:
+        theme_code(pad, ctx, tok)
 
-    return (newlines * "\n") + r
+    return (r, newlines == 1)
 
-def theme_reset():
-    for key in attr_count:
-        attr_count[key] = 0
-    color_stack = []
+def theme_lstrip(pad, ctx, uni):
+    r, newline = theme_lstrip_at(pad, ctx, uni, 0)
+    if newline:
+        return "\n" + uni[r:]
+    return uni[r:]
 
 utf_chars = { "ls" : "│",
               "rs" : "│",
@@ -78,6 +78,84 @@ static PyObject *py_waddch(PyObject * self, PyObject * args)
 	return ret_o;
 }
 
+/* Bulk version of wcwidth, returns a tuple of the widths of every character
+   in a string, so callers don't need a call (and an encode) per character */
+
+static PyObject *py_wcwidths(PyObject * self, PyObject * args)
+{
+	PyObject *string, *ret, *width;
+	wchar_t *wstr;
+	Py_ssize_t len, i;
+
+	if (!PyArg_ParseTuple(args, "U", &string))
+		return NULL;
+
+	wstr = PyUnicode_AsWideCharString(string, &len);
+	if (wstr == NULL)
+		return NULL;
+
+	ret = PyTuple_New(len);
+	if (ret == NULL) {
+		PyMem_Free(wstr);
+		return NULL;
+	}
+
+	for (i = 0; i < len; i++) {
+		width = PyLong_FromLong(wcwidth(wstr[i]));
+		if (width == NULL) {
+			Py_DECREF(ret);
+			PyMem_Free(wstr);
+			return NULL;
+		}
+		PyTuple_SET_ITEM(ret, i, width);
+	}
+
+	PyMem_Free(wstr);
+	return ret;
+}
+
+static PyObject *py_waddnwstr(PyObject * self, PyObject * args)
+{
+	PyObject *window, *string;
+	WINDOW *win;
+	wchar_t *wstr;
+	Py_ssize_t len, i;
+	int x, y, width;
+
+	if (!PyArg_ParseTuple(args, "OU", &window, &string))
+		return NULL;
+
+	if (window != Py_None)
+		win = ((PyCursesWindowObject *) window)->win;
+	else
+		Py_RETURN_NONE;
+
+	wstr = PyUnicode_AsWideCharString(string, &len);
+	if (wstr == NULL)
+		return NULL;
+
+	getyx(win, y, x);
+
+	waddnwstr(win, wstr, (int)len);
+
+	/* Like waddch, place the cursor ourselves rather than trusting curses
+	   to advance it correctly over wide characters */
+
+	for (i = 0; i < len; i++) {
+		if (wstr[i] > 0x7F) {
+			width = wcwidth(wstr[i]);
+			if (width > 0)
+				x += width;
+		} else
+			x++;
+	}
+
+	wmove(win, y, x);
+
+	PyMem_Free(wstr);
+	Py_RETURN_NONE;
+}
+
 static PyObject *py_wsize(PyObject * self, PyObject * args)
 {
 	return Py_BuildValue("i", sizeof(WINDOW));
@@ -215,6 +293,10 @@ static PyMethodDef WCMethods[] = {
 	{"waddch", (PyCFunction) py_waddch, METH_VARARGS, "waddch() wrapper."},
 	{"wcwidth", (PyCFunction) py_wcwidth, METH_VARARGS,
 	 "wcwidth() wrapper."},
+	{"wcwidths", (PyCFunction) py_wcwidths, METH_VARARGS,
+	 "Returns wcwidth() of every character in a string."},
+	{"waddnwstr", (PyCFunction) py_waddnwstr, METH_VARARGS,
+	 "waddnwstr() wrapper."},
 	{"wsize", (PyCFunction) py_wsize, METH_VARARGS,
 	 "Returns sizeof(WINDOW)"},
 	{"set_redisplay_callback", (PyCFunction) py_set_redisplay_callback,
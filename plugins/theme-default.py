@@ -9,8 +9,8 @@ from canto_next.plugins import check_program
 
 check_program("canto-curses")
 
-from canto_curses.story import StoryPlugin
-from canto_curses.tag import TagPlugin
+from canto_curses.story import StoryPlugin, story_format
+from canto_curses.tag import TagPlugin, tag_format
 from canto_curses.theme import prep_for_display
 from canto_curses.color import cc
 
@@ -21,6 +21,11 @@ if FORCE_COLORS:
 if FORCE_STYLE:
     cmds.append("reset-config style")
 
+# Formats are compiled by cc.template once per combination of states (and
+# again whenever the color / style config changes), so evaluating a story or
+# tag only has to fill in the variable parts. This theme uses the builders
+# from story and tag as they are, a theme based on it can define its own.
+
 class CantoThemeStoryDefault(StoryPlugin):
     def __init__(self, story):
         self.story = story
@@ -28,33 +33,11 @@ class CantoThemeStoryDefault(StoryPlugin):
 
     def eval(self):
         story = self.story
-        s = ""
-
-        if "read" in story.content["canto-state"]:
-            s += cc("read")
-        else:
-            s += cc("unread")
-
-        if story.marked:
-            s += cc("marked") + "[*]"
-
-        if story.selected:
-            s += cc("selected")
 
-        s += prep_for_display(story.content["title"])
+        read = "read" in story.content["canto-state"]
+        pre, post = cc.template(story_format, read, story.marked, story.selected)
 
-        if story.selected:
-            s += cc.end("selected")
-
-        if story.marked:
-            s += cc.end("marked")
-
-        if "read" in story.content["canto-state"]:
-            s += cc.end("read")
-        else:
-            s += cc.end("unread")
-
-        return s
+        return pre + prep_for_display(story.content["title"]) + post
 
 class CantoThemeTagDefault(TagPlugin):
     def __init__(self, tag):
@@ -67,29 +50,13 @@ class CantoThemeTagDefault(TagPlugin):
         # Make sure to strip out the category from category:name
         str_tag = tag.tag.split(':', 1)[1]
 
-        unread = len([s for s in tag\
-                if "canto-state" not in s.content or\
-                "read" not in s.content["canto-state"]])
-
-        s = ""
-
-        if tag.selected:
-            s += cc("selected")
+        fmt = cc.template(tag_format, tag.selected, tag.collapsed,
+                tag.updates_pending > 0)
 
-        if tag.collapsed:
-            s += "[+]"
-        else:
-            s += "[-]"
-
-        s += " " + str_tag + " "
-
-        s += "[" + cc("unread") + str(unread) + cc.end("unread") + "]"
+        s = fmt[0] + str_tag + fmt[1] + str(tag.unread_count) + fmt[2]
 
         if tag.updates_pending:
-            s += " [" + cc("pending") + str(tag.updates_pending) + cc.end("pending") + "]"
-
-        if tag.selected:
-            s += cc.end("selected")
+            s += str(tag.updates_pending) + fmt[3]
 
         return s
 
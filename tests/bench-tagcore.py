@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# TagCore micro-benchmarks, on tags of IDS item ids.
+#
+#   ./bench-tagcore.py
+#
+# Times an ITEMS update (diffing the old ids against the new) and dropping the
+# removed stories' attributes, and checks that the diff agrees with, and beats,
+# the sorted merge it replaced, which is kept here for reference.
+
+from base import *
+
+from canto_curses.main import CANTO_PROTOCOL_COMPATIBLE
+from canto_curses.config import config
+from canto_curses.tagcore import tag_updater, TagCore, alltagcores
+
+import random
+import time
+
+IDS = 100000
+
+# Fraction of ids that are new (and, so, old) in each update.
+CHURN = 0.1
+
+REPEAT = 3
+
+# The diff as prot_items used to do it, a merge of sorted lists that pops from
+# the front of one of them.
+
+def merge_diff(current, updated):
+    sorted_updated_ids = list(enumerate(updated))
+    sorted_updated_ids.sort(key=lambda x : x[1])
+
+    sorted_current_ids = list(enumerate(current))
+    sorted_current_ids.sort(key=lambda x : x[1])
+
+    new_ids = []
+    cur_ids = []
+    old_ids = []
+
+    for c_place, c_id in sorted_current_ids:
+        while sorted_updated_ids and c_id > sorted_updated_ids[0][1]:
+            new_ids.append(sorted_updated_ids.pop(0))
+
+        if not sorted_updated_ids or c_id < sorted_updated_ids[0][1]:
+            old_ids.append(c_id)
+        else:
+            cur_ids.append(sorted_updated_ids.pop(0))
+
+    new_ids += sorted_updated_ids
+
+    return ([ x[1] for x in new_ids ], old_ids, [ x[1] for x in cur_ids ])
+
+class FakeTag(object):
+    def __init__(self, tag):
+        self.tag = tag
+
+class FakeStory(object):
+    def __init__(self, id):
+        self.id = id
+
+def best(fn):
+    t = None
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if t == None or elapsed < t:
+            t = elapsed
+    return t
+
+class TagCoreBench(Test):
+    def check(self):
+        config_script = {
+            'VERSION' : { '*' : [('VERSION', CANTO_PROTOCOL_COMPATIBLE)] },
+            'CONFIGS' : { '*' : [('CONFIGS', { "CantoCurses" : config.template_config })] },
+        }
+
+        config.init(TestBackend("config", config_script), CANTO_PROTOCOL_COMPATIBLE)
+        tag_updater.init(TestBackend("tagcore", {}))
+
+        r = random.Random(0)
+
+        # Ids look like the daemon's, feed URL plus item id. Updates drop the
+        # oldest items and prepend new ones.
+
+        def item_id(i):
+            return '{"URL":"http://example.com/feed","ID":"item-%d"}' % i
+
+        churn = int(IDS * CHURN)
+
+        current = [ item_id(i) for i in range(IDS) ]
+        r.shuffle(current)
+        updated = [ item_id(IDS + i) for i in range(churn) ] + current[:-churn]
+
+        tc = TagCore("maintag:bench")
+        tc.set_items(current)
+
+        added, removed, kept = tc.diff(updated)
+        m_added, m_removed, m_kept = merge_diff(current, updated)
+
+        if set(added) != set(m_added) or set(removed) != set(m_removed) or\
+                set(kept) != set(m_kept):
+            print("Diff disagrees with the sorted merge")
+            return False
+
+        if added != updated[:churn] or removed != current[-churn:]:
+            print("Diff isn't in list order")
+            return False
+
+        diff_t = best(lambda : tc.diff(updated))
+        merge_t = best(lambda : merge_diff(current, updated))
+
+        print("%-28s %10.1f ms" % ("TagCore.diff", diff_t * 1000))
+        print("%-28s %10.1f ms" % ("sorted merge (old)", merge_t * 1000))
+
+        # A whole ITEMS update, and then the GUI dropping the removed
+        # stories, which checks every one of them against the TagCore.
+
+        def items_update():
+            tc.set_items(current)
+            tag_updater.prot_items({ "maintag:bench" : updated })
+
+        items_t = best(items_update)
+        print("%-28s %10.1f ms" % ("prot_items", items_t * 1000))
+
+        tag = FakeTag("maintag:bench")
+        stories = [ FakeStory(id) for id in removed ]
+
+        removed_t = best(lambda : tag_updater.on_stories_removed(tag, stories))
+        print("%-28s %10.1f ms" % ("on_stories_removed", removed_t * 1000))
+
+        # Membership used to be a list search, so removing n stories was
+        # O(n * IDS). Time a sample of old style lookups and extrapolate.
+
+        sample = stories[:100]
+        start = time.perf_counter()
+        for s in sample:
+            list.__contains__(tc, s.id)
+        list_t = (time.perf_counter() - start) * len(stories) / len(sample)
+        print("%-28s %10.1f ms (estimated)" % ("list membership (old)", list_t * 1000))
+
+        alltagcores.remove(tc)
+
+        if diff_t >= merge_t:
+            print("REGRESSION diff is slower than the sorted merge")
+            return False
+
+        if removed_t >= list_t:
+            print("REGRESSION removal is slower than list membership")
+            return False
+
+        return True
+
+TagCoreBench("tagcore bench")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.modules['curses'] = __import__("fake_curses")
+sys.modules['canto_curses.widecurse'] = __import__("fake_widecurse")
+
+from base import *
+
+from canto_curses.theme import FakePad, ThemeContext, theme_compile, theme_print_at, theme_lstrip_at
+
+import time
+
+# Synthetic reader body, roughly what the reader produces from HTML: words,
+# some markup codes, escapes, wide characters and the odd newline.
+
+PARAGRAPH = "Lorem ipsum %Bdolor%b sit amet, %1consectetur%0 adipiscing "\
+        "elit, sed do \\%eiusmod tempor 日本語のテキスト incididunt ut "\
+        "labore et %Udolore%u magna aliqua. Ut enim ad minim veniam, quis "\
+        "nostrud exercitationullamcolaborisnisiutaliquipexeacommodo "\
+        "consequat.\n\n"
+
+WIDTH = 80
+CHARS = 262144
+
+class ThemeWrapBench(Test):
+    def body(self, size):
+        return (PARAGRAPH * (size // len(PARAGRAPH) + 1))[:size]
+
+    def layout(self, s):
+        pad = FakePad(WIDTH)
+        ctx = ThemeContext()
+        lines = 0
+
+        pos = 0
+        while pos != None:
+            pos, newline = theme_lstrip_at(pad, ctx, s, pos)
+            if pos >= len(s):
+                break
+            if newline:
+                theme_print_at(pad, ctx, "", 0, WIDTH, " ", " ")
+                lines += 1
+            pos = theme_print_at(pad, ctx, s, pos, WIDTH, " ", " ")
+            lines += 1
+
+        return lines
+
+    # Best time per character, across a few cold runs. Small bodies are laid
+    # out several times per run, so every run covers about CHARS characters
+    # and the small sizes aren't all noise.
+
+    def time_per_char(self, s):
+        reps = max(1, CHARS // len(s))
+        best = None
+        for i in range(5):
+            start = time.perf_counter()
+            for j in range(reps):
+                theme_compile.cache_clear()
+                self.layout(s)
+            t = time.perf_counter() - start
+            if best == None or t < best:
+                best = t
+        return best / (len(s) * reps)
+
+    def check(self):
+        sizes = [ 2048, 16384, CHARS ]
+        times = []
+
+        for size in sizes:
+            t = self.time_per_char(self.body(size))
+            print("%6d chars - %.3f us/char" % (size, t * 1000000))
+            times.append(t)
+
+        # Linear layout should cost about the same per character regardless
+        # of body size. Anything quadratic, even with a small constant (like
+        # copying the rest of the tokens for every line), shows up well
+        # beyond this by 256k.
+
+        if times[-1] > times[0] * 1.5:
+            print("Layout not linear: %.3f us/char -> %.3f us/char" %\
+                    (times[0] * 1000000, times[-1] * 1000000))
+            return False
+
+        return True
+
+ThemeWrapBench("theme wrap bench")
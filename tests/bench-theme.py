@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Theme engine micro-benchmarks, on a synthetic corpus.
+#
+#   ./bench-theme.py            run and compare against the saved baseline
+#   ./bench-theme.py --save     run and save the results as the new baseline
+#
+# The baseline is kept in bench-theme.json (not checked in, since it's only
+# meaningful on the machine that generated it). Save one before a change, and
+# the run after will fail if any benchmark's throughput drops, or peak memory
+# per line grows, by more than THRESHOLD.
+
+import sys
+
+sys.modules['curses'] = __import__("fake_curses")
+sys.modules['canto_curses.widecurse'] = __import__("fake_widecurse")
+
+from base import *
+
+from canto_curses.theme import FakePad, ThemeContext, theme_compile, theme_print_at, theme_len, prep_for_display
+from canto_curses.main import CANTO_PROTOCOL_COMPATIBLE
+from canto_curses.config import config
+from canto_curses.tagcore import tag_updater
+from canto_curses.story import Story
+from canto_curses.color import cc
+
+import tracemalloc
+import random
+import time
+import json
+import os
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench-theme.json")
+THRESHOLD = 0.20
+
+WIDTH = 80
+TITLES = 10000
+
+# Timing is the best of REPEAT cold runs (the theme_compile cache is cleared
+# first). Peak memory is tracemalloc's peak divided by the number of lines laid
+# out, measured on the first ALLOC_TITLES titles because tracemalloc is slow.
+# That run is warm, so the theme_compile cache isn't part of the peak, only
+# what laying out the lines needs on its own.
+
+REPEAT = 3
+ALLOC_TITLES = 1000
+
+words = [ "canto", "rss", "reader", "curses", "feed", "the", "of", "update",
+        "kernel", "release", "announcing", "version", "security", "fix" ]
+
+cjk = "日本語中文한국어漢字仮名交じり文書体系統計算機"
+
+emoji = "😀🎉🔥🚀📰✨🐍💡🌍🎵"
+
+codes = [ "%1", "%2", "%8", "%0", "%B", "%b", "%U", "%u", "%R", "%r", "%[42]", "%C", "%c" ]
+
+def gen_ascii(r):
+    return " ".join(r.choice(words) for i in range(r.randint(3, 15)))
+
+def gen_cjk(r):
+    return " ".join("".join(r.choice(cjk) for j in range(r.randint(2, 8)))\
+            for i in range(r.randint(2, 8)))
+
+def gen_emoji(r):
+    return " ".join(r.choice(words) + r.choice(emoji) for i in range(r.randint(3, 12)))
+
+def gen_codes(r):
+    return " ".join(r.choice(codes) + r.choice(words) + r.choice(codes)\
+            for i in range(r.randint(3, 15)))
+
+def gen_long(r):
+    return " ".join("".join(r.choice(words) for j in range(r.randint(1, 20)))\
+            for i in range(r.randint(2, 6)))
+
+generators = [ ("ascii", gen_ascii), ("cjk", gen_cjk), ("emoji", gen_emoji),
+        ("codes", gen_codes), ("longwords", gen_long) ]
+
+# Raw titles, as they'd come from the daemon, with escapes and entities.
+
+def gen_raw(r):
+    return r.choice([gen_ascii, gen_cjk, gen_emoji, gen_long])(r) +\
+            r.choice([ "", " &amp; more", " 100%", " &#8212; \\o/", " &lt;b&gt;" ])
+
+def layout(pad, ctx, s):
+    lines = 0
+    pos = 0 if s else None
+    while pos != None:
+        pos = theme_print_at(pad, ctx, s, pos, WIDTH, " ", " ")
+        lines += 1
+    return lines
+
+def bench_theme_print(titles):
+    lines = 0
+    for t in titles:
+        lines += layout(FakePad(WIDTH), ThemeContext(), t)
+    return lines
+
+def bench_theme_len(titles):
+    for t in titles:
+        theme_len(t)
+    return len(titles)
+
+def bench_prep_for_display(titles):
+    for t in titles:
+        prep_for_display(t)
+    return len(titles)
+
+class BenchStory(Story):
+    def __init__(self, title, callbacks):
+        Story.__init__(self, None, title, callbacks)
+        self.materialize()
+        self.content = { "title" : title, "canto-state" : [] }
+
+# Stories look up options through callbacks, which copy the whole config on
+# every call in the client. Use a snapshot so this measures rendering.
+
+def story_callbacks():
+    conf = config.get_conf()
+
+    def get_opt(option):
+        valid, value = access_dict(conf, option)
+        if not valid:
+            return None
+        return value
+
+    return {
+        "get_opt" : get_opt,
+        "get_tag_opt" : lambda x : False,
+        "set_var" : lambda x, y : None,
+        "release_gui" : lambda : None,
+    }
+
+class ThemeBench(Test):
+    def corpus(self):
+        r = random.Random(0)
+
+        self.corpora = []
+        for name, gen in generators:
+            self.corpora.append((name, [ gen(r) for i in range(TITLES // len(generators)) ]))
+
+        mixed = []
+        for name, titles in self.corpora:
+            mixed.extend(titles)
+        r.shuffle(mixed)
+        self.corpora.append(("mixed", mixed))
+
+        self.raw = [ gen_raw(r) for i in range(TITLES) ]
+
+    def run_one(self, fn, items, chars):
+        best = None
+        for i in range(REPEAT):
+            theme_compile.cache_clear()
+            start = time.perf_counter()
+            fn(items)
+            t = time.perf_counter() - start
+            if best == None or t < best:
+                best = t
+
+        subset = items[:ALLOC_TITLES]
+        fn(subset)
+        tracemalloc.start()
+        alloc_lines = fn(subset)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return { "chars_per_sec" : chars / best,
+                 "peak_bytes_per_line" : peak / max(alloc_lines, 1) }
+
+    def benchmarks(self):
+        for name, titles in self.corpora:
+            chars = sum([ len(t) for t in titles ])
+            yield ("theme_print/" + name, bench_theme_print, titles, chars)
+            yield ("theme_len/" + name, bench_theme_len, titles, chars)
+
+        chars = sum([ len(t) for t in self.raw ])
+        yield ("prep_for_display/raw", bench_prep_for_display, self.raw, chars)
+
+        callbacks = story_callbacks()
+        stories = [ BenchStory(t, callbacks) for t in self.raw ]
+
+        def bench_story_render(stories):
+            lines = 0
+            for s in stories:
+                s.changed = True
+                lines += s.lines(WIDTH)
+            return lines
+
+        yield ("Story.render/raw", bench_story_render, stories, chars)
+
+        for s in stories:
+            s.die()
+
+    def check(self):
+        config_script = {
+            'VERSION' : { '*' : [('VERSION', CANTO_PROTOCOL_COMPATIBLE)] },
+            'CONFIGS' : { '*' : [('CONFIGS', { "CantoCurses" : config.template_config })] },
+        }
+
+        config.init(TestBackend("config", config_script), CANTO_PROTOCOL_COMPATIBLE)
+        tag_updater.init(TestBackend("tagcore", {}))
+
+        cc.color_conf = config.get_opt("color")
+        cc.style_conf = config.get_opt("style")
+        cc.reset_cache()
+
+        self.corpus()
+
+        results = {}
+        for name, fn, items, chars in self.benchmarks():
+            results[name] = self.run_one(fn, items, chars)
+            print("%-28s %12.0f chars/s %10.1f peak B/line" %\
+                    (name, results[name]["chars_per_sec"], results[name]["peak_bytes_per_line"]))
+
+        if "--save" in sys.argv:
+            with open(BASELINE, "w") as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+            print("\nSaved baseline to %s" % BASELINE)
+            return True
+
+        if not os.path.exists(BASELINE):
+            print("\nNo baseline, run with --save to create one.")
+            return True
+
+        with open(BASELINE, "r") as f:
+            baseline = json.load(f)
+
+        ok = True
+        for name in results:
+            if name not in baseline or\
+                    "peak_bytes_per_line" not in baseline[name]:
+                continue
+
+            speed = results[name]["chars_per_sec"] / baseline[name]["chars_per_sec"]
+            if speed < 1 - THRESHOLD:
+                print("REGRESSION %s: %.0f%% of baseline throughput" % (name, speed * 100))
+                ok = False
+
+            peak = results[name]["peak_bytes_per_line"] /\
+                    max(baseline[name]["peak_bytes_per_line"], 1)
+            if peak > 1 + THRESHOLD:
+                print("REGRESSION %s: %.0f%% of baseline peak memory" % (name, peak * 100))
+                ok = False
+
+        return ok
+
+ThemeBench("theme bench")
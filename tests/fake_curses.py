@@ -59,6 +59,9 @@ class CursesPad():
     def attroff(self, attr):
         self.attrs ^= attr
 
+    def attrset(self, attr):
+        self.attrs = attr
+
     def clrtoeol(self):
         y = self.y
         while y == self.y:
@@ -78,6 +81,10 @@ class CursesPad():
             self.y += 1
             self.x -= self.width
 
+    def waddnwstr(self, s):
+        for c in s:
+            self.waddch(c)
+
     def overwrite(self, dest_pad, sminrow, smincol, dminrow, dmincol, dmaxrow, dmaxcol):
         rows = (dmaxrow - dminrow) + 1
         cols = (dmaxcol - dmincol) + 1
@@ -3,6 +3,9 @@
 def waddch(pad, ch):
     pad.waddch(ch)
 
+def waddnwstr(pad, s):
+    pad.waddnwstr(s)
+
 import sys
 
 self = sys.modules[__name__]
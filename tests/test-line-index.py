@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.modules['curses'] = __import__("fake_curses")
+sys.modules['canto_curses.widecurse'] = __import__("fake_widecurse")
+
+from base import *
+
+from canto_curses.taglist import LineIndex
+
+import random
+
+class LineIndexTest(Test):
+    def compare(self, index, counts):
+        for i in range(len(counts) + 1):
+            if index.line(i) != sum(counts[:i]):
+                print("line(%d) = %d, expected %d" % (i, index.line(i), sum(counts[:i])))
+                return False
+
+        for line in range(-1, sum(counts) + 2):
+            expected = 0
+            for i in range(len(counts)):
+                if sum(counts[:i]) <= line:
+                    expected = i
+
+            if index.find(line) != expected:
+                print("find(%d) = %d, expected %d (%s)" % (line, index.find(line), expected, counts))
+                return False
+
+        return True
+
+    def check(self):
+        r = random.Random(0)
+
+        if LineIndex([]).find(0) != None:
+            return False
+
+        for i in range(200):
+            counts = [ r.choice([0, 1, 1, 2, 5]) for j in range(r.randint(1, 40)) ]
+            index = LineIndex(counts)
+
+            if not self.compare(index, counts):
+                return False
+
+            for j in range(10):
+                k = r.randrange(len(counts))
+                counts[k] = r.choice([0, 1, 3])
+                index[k] = counts[k]
+
+            if not self.compare(index, counts):
+                return False
+
+        return True
+
+LineIndexTest("line index")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_curses.search import SearchIndex, regex_literals
+
+import random
+import re
+
+words = [ "foo", "bar", "Baz", "qux", "a.b", "x", "日本語", "hello world", "the", "(", ")", "*" ]
+
+class SearchIndexTest(Test):
+    def compare(self, index, docs, regex, literals):
+        rgx = re.compile(regex)
+        expected = set([ i for i in docs if rgx.match(docs[i]["title"]) ])
+        got = index.search(rgx, literals)
+
+        if got != expected:
+            print("'%s' (%s) matched %s, expected %s" % (regex, literals, got, expected))
+            return False
+        return True
+
+    def check(self):
+        r = random.Random(0)
+
+        def title():
+            return "".join([ r.choice(words) + r.choice([ "", " ", "-", "\n" ])\
+                    for i in range(r.randint(0, 6)) ])
+
+        docs = {}
+        index = SearchIndex([ "title" ])
+
+        for i in range(400):
+            docs[i] = { "title" : title() }
+            index.update(i, docs[i])
+
+        # Updates and removals have to take old postings with them.
+
+        for i in r.sample(range(400), 100):
+            docs[i] = { "title" : title() }
+            index.update(i, docs[i])
+
+        for i in r.sample(range(400), 50):
+            del docs[i]
+            index.remove(i)
+
+        for term in [ "foo", "Ba", "x", "a.b", "qux bar", "日本", "o w", "e", "*", "(", "o-", "zz" ]:
+            if not self.compare(index, docs, ".*" + re.escape(term) + ".*", [ term ]):
+                return False
+
+        for regex in [ "fo+o", "ba[rz]", "^the", "qu?x", "f.o", "(foo)?bar", "a\\.b",
+                "\\w+ar", "x{2}", "foo|bar", "(?i)foo", "[)]x", "Baz$", "he.*d" ]:
+            if not self.compare(index, docs, regex, regex_literals(regex)):
+                return False
+
+        # Narrowing a previous result has to give the same answer as
+        # searching from scratch.
+
+        prev = index.search(re.compile(".*o.*"), [ "o" ])
+        for term in [ "fo", "foo", "o w", "oo" ]:
+            rgx = re.compile(".*" + re.escape(term) + ".*")
+            if index.search(rgx, [ term ], prev) != index.search(rgx, [ term ]):
+                print("narrowing '%s' from 'o' didn't match a full search" % term)
+                return False
+
+        return True
+
+SearchIndexTest("search index")